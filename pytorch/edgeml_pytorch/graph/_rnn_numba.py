@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+'''
+Numba kernels for the recurrence of GRULRCell and UGRNNLRCell at inference
+on the CPU. For the small hidden sizes these cells are used with, the
+per-step dispatch of PyTorch ops costs more than the arithmetic itself;
+these kernels run the whole time loop in compiled code instead.
+
+numba is an optional dependency and the kernels are only used by cells
+on which use_numba has been called. AVAILABLE is False when numba is
+missing and the cells then keep to their PyTorch implementation. The
+kernels use exact activations without fastmath, so they agree with
+PyTorch up to the order of the floating point sums.
+'''
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+# Largest hidden size routed to these kernels; beyond it the per-step GEMMs
+# dominate and MKL/OpenBLAS beat the naive loops below
+MAX_HIDDEN_SIZE = 128
+
+
+if AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def gru_forward(wComps, U1, U2, U3, h0):
+        '''
+        wComps = [timeSteps, batchSize, 3 * hidden] input projections with
+        the r, z and update biases already added
+        U1, U2, U3 = [hidden, hidden] recurrent matrices
+        h0 = [batchSize, hidden] initial state
+
+        Returns the [timeSteps, batchSize, hidden] hidden states for the
+        sigmoid gate and tanh update nonlinearities
+        '''
+        timeSteps, batchSize = wComps.shape[0], wComps.shape[1]
+        H = h0.shape[1]
+        out = np.empty((timeSteps, batchSize, H), dtype=wComps.dtype)
+        # Gate scratch shared by all timesteps, one row per batch element
+        r = np.empty((batchSize, H), dtype=wComps.dtype)
+        z = np.empty((batchSize, H), dtype=wComps.dtype)
+        for t in range(timeSteps):
+            # The previous state is read in place from h0 or out[t - 1]
+            h = h0 if t == 0 else out[t - 1]
+            for b in prange(batchSize):
+                for j in range(H):
+                    preR = wComps[t, b, j]
+                    preZ = wComps[t, b, H + j]
+                    for k in range(H):
+                        preR += h[b, k] * U1[k, j]
+                        preZ += h[b, k] * U2[k, j]
+                    r[b, j] = 1.0 / (1.0 + np.exp(-preR))
+                    z[b, j] = 1.0 / (1.0 + np.exp(-preZ))
+                for j in range(H):
+                    preC = wComps[t, b, 2 * H + j]
+                    for k in range(H):
+                        preC += r[b, k] * h[b, k] * U3[k, j]
+                    out[t, b, j] = z[b, j] * h[b, j] + \
+                        (1.0 - z[b, j]) * np.tanh(preC)
+        return out
+
+    @njit(parallel=True, cache=True)
+    def ugrnn_forward(wComps, U1, U2, h0):
+        '''
+        wComps = [timeSteps, batchSize, 2 * hidden] input projections with
+        the gate and update biases already added
+        U1, U2 = [hidden, hidden] recurrent matrices
+        h0 = [batchSize, hidden] initial state
+
+        Returns the [timeSteps, batchSize, hidden] hidden states for the
+        sigmoid gate and tanh update nonlinearities
+        '''
+        timeSteps, batchSize = wComps.shape[0], wComps.shape[1]
+        H = h0.shape[1]
+        out = np.empty((timeSteps, batchSize, H), dtype=wComps.dtype)
+        for t in range(timeSteps):
+            # The previous state is read in place from h0 or out[t - 1]
+            h = h0 if t == 0 else out[t - 1]
+            for b in prange(batchSize):
+                for j in range(H):
+                    preZ = wComps[t, b, j]
+                    preC = wComps[t, b, H + j]
+                    for k in range(H):
+                        preZ += h[b, k] * U1[k, j]
+                        preC += h[b, k] * U2[k, j]
+                    z = 1.0 / (1.0 + np.exp(-preZ))
+                    out[t, b, j] = z * h[b, j] + (1.0 - z) * np.tanh(preC)
+        return out
@@ -4,13 +4,24 @@
 import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
 import numpy as np
 
 import edgeml_pytorch.utils as utils
+import edgeml_pytorch.graph._rnn_numba as _rnn_numba
 
+fastgrnn_cuda = None
 if utils.findCUDA() is not None:
-    import fastgrnn_cuda
+    # A CUDA toolkit does not mean the extension has been built
+    try:
+        import fastgrnn_cuda
+    except ImportError:
+        fastgrnn_cuda = None
+
+# Gate nonlinearities implemented by the fastgrnn_cuda kernels
+_CUDA_GATE_NONLINEARITIES = {"sigmoid": 0, "relu": 1, "tanh": 2}
 
 def onnx_exportable_rnn(input, fargs, cell, output):
     class RNNSymbolic(Function):
@@ -33,37 +44,280 @@ def onnx_exportable_rnn(input, fargs, cell, output):
 
     return RNNSymbolic.apply(input, *fargs)
 
+def _quant_tanh(A):
+    return torch.clamp(A, -1.0, 1.0)
+
+def _quant_sigm(A):
+    return torch.clamp((A + 1.0) * 0.5, 0.0, 1.0)
+
+def _quant_sigm4(A):
+    return torch.clamp((A + 2.0) * 0.25, 0.0, 1.0)
+
+_NONLINEARITIES = {
+    "tanh": torch.tanh,
+    "sigmoid": torch.sigmoid,
+    "relu": torch.relu,
+    "quantTanh": _quant_tanh,
+    "quantSigm": _quant_sigm,
+    "quantSigm4": _quant_sigm4,
+    "hardSigm": F.hardsigmoid,
+    "hardTanh": F.hardtanh,
+}
+
+def resolve_nonlinearity(nonlinearity):
+    '''
+    Returns the function implementing a nonlinearity
+
+    nonlinearity is either a callable or a value in
+        ['tanh', 'sigmoid', 'relu', 'quantTanh', 'quantSigm', 'quantSigm4',
+         'hardSigm', 'hardTanh']
+    None (no nonlinearity configured) is passed through
+    '''
+    if nonlinearity is None:
+        return None
+    if isinstance(nonlinearity, str) and nonlinearity in _NONLINEARITIES:
+        return _NONLINEARITIES[nonlinearity]
+    # nonlinearity is a user specified function
+    if not callable(nonlinearity):
+        raise ValueError("nonlinearity is either a callable or a value " +
+                         "['tanh', 'sigmoid', 'relu', 'quantTanh', " +
+                         "'quantSigm', 'quantSigm4', 'hardSigm', " +
+                         "'hardTanh']")
+    return nonlinearity
+
 def gen_nonlinearity(A, nonlinearity):
     '''
     Returns required activation for a tensor based on the inputs
 
     nonlinearity is either a callable or a value in
-        ['tanh', 'sigmoid', 'relu', 'quantTanh', 'quantSigm', 'quantSigm4']
+        ['tanh', 'sigmoid', 'relu', 'quantTanh', 'quantSigm', 'quantSigm4',
+         'hardSigm', 'hardTanh']
+    '''
+    return resolve_nonlinearity(nonlinearity)(A)
+
+def _weights_key(mats):
+    '''
+    Identifies the current contents of a list of tensors by their storage
+    and in-place version counters, so derived values can be cached
+    '''
+    return tuple((mat.data_ptr(), mat._version) for mat in mats)
+
+def _gemm(input, mat, add=None, out=None):
+    '''
+    matmul(input, mat), or addmm(add, input, mat) for a 2-D input. When mat
+    has been cast to a lower precision by to_bf16_inference, only the
+    operands of the product are taken in that precision: the product is
+    upcast to the dtype of input before add, so biases and states keep it
+    '''
+    if mat.dtype != input.dtype:
+        prod = torch.matmul(input.to(mat.dtype), mat).to(input.dtype)
+        if add is None:
+            return prod if out is None else out.copy_(prod)
+        return torch.add(add, prod, out=out)
+    if add is None:
+        return torch.matmul(input, mat, out=out)
+    return torch.addmm(add, input, mat, out=out)
+
+def _addmm_nd(bias, input, mat):
+    '''
+    bias + matmul(input, mat) for an input with any number of leading
+    dimensions, with the bias add done inside the GEMM
     '''
-    if nonlinearity == "tanh":
-        return torch.tanh(A)
-    elif nonlinearity == "sigmoid":
-        return torch.sigmoid(A)
-    elif nonlinearity == "relu":
-        return torch.relu(A, 0.0)
-    elif nonlinearity == "quantTanh":
-        return torch.max(torch.min(A, torch.ones_like(A)), -1.0 * torch.ones_like(A))
-    elif nonlinearity == "quantSigm":
-        A = (A + 1.0) / 2.0
-        return torch.max(torch.min(A, torch.ones_like(A)), torch.zeros_like(A))
-    elif nonlinearity == "quantSigm4":
-        A = (A + 2.0) / 4.0
-        return torch.max(torch.min(A, torch.ones_like(A)), torch.zeros_like(A))
+    out = _gemm(input.reshape(-1, input.shape[-1]), mat, add=bias)
+    return out.reshape(input.shape[:-1] + (mat.shape[-1],))
+
+def _low_rank_project(input, W, Wi, bias=None):
+    '''
+    matmul(matmul(input, W), Wi) (+ bias) for an input with any number of
+    leading dimensions. W and Wi are folded into a single matrix first when
+    that takes fewer flops for this many rows
+    '''
+    inDim, rank = W.shape
+    outDim = Wi.shape[1]
+    rows = input.numel() // inDim
+    if rows * inDim * outDim + inDim * rank * outDim < \
+            rows * rank * (inDim + outDim):
+        projected, mat = input, torch.matmul(W, Wi)
     else:
-        # nonlinearity is a user specified function
-        if not callable(nonlinearity):
-            raise ValueError("nonlinearity is either a callable or a value " +
-                             + "['tanh', 'sigmoid', 'relu', 'quantTanh', " +
-                             "'quantSigm'")
-        return nonlinearity(A)
+        projected, mat = _gemm(input, W), Wi
+    if bias is None:
+        return _gemm(projected, mat)
+    return _addmm_nd(bias, projected, mat)
+
+def _normal_param(shape, factory_kwargs):
+    '''
+    Parameter drawn from N(0, 0.1^2), sampled in place on the requested
+    device and dtype rather than as 0.1 * randn on the CPU
+    '''
+    return nn.Parameter(torch.empty(shape, **factory_kwargs).normal_(0.0, 0.1))
+
+def _const_param(shape, value, factory_kwargs):
+    return nn.Parameter(torch.full(shape, value, **factory_kwargs))
+
+@torch.jit.script
+def fastgrnn_step(wComp, uComp, state, bias_gate, bias_update,
+                  sigmZeta, sigmZetaNu):
+    '''
+    Scripted FastGRNN update for the default sigmoid/tanh nonlinearities so
+    that the pointwise ops of a timestep run as a single fused kernel
+
+    The shared pre-activation Wx_t + Uh_{t-1} is formed inside the script so
+    the fuser folds it into both bias adds instead of materialising it.
+    sigmZeta and sigmZetaNu are sigmoid(zeta) and sigmoid(zeta) + sigmoid(nu),
+    which are constant over a sequence. The update
+        z*h + (sigmoid(zeta)*(1 - z) + sigmoid(nu))*c
+    is rearranged as z*(h - sigmZeta*c) + sigmZetaNu*c so that no (1 - z)
+    intermediate is needed
+    '''
+    pre_comp = wComp + uComp
+    z = torch.sigmoid(pre_comp + bias_gate)
+    c = torch.tanh(pre_comp + bias_update)
+    return z * (state - sigmZeta * c) + sigmZetaNu * c
+
+@torch.jit.script
+def fastgrnn_unroll(wComps, state, U, bias_gate, bias_update,
+                    sigmZeta, sigmZetaNu):
+    '''
+    Scripted FastGRNN recurrence over time major input projections wComps
+    of shape [timeSteps, batchSize, hidden_size]. Exported to ONNX this
+    becomes a single Loop op around the fused step
+    '''
+    hiddenStates = []
+    for t in range(wComps.size(0)):
+        state = fastgrnn_step(wComps[t], torch.matmul(state, U), state,
+                              bias_gate, bias_update, sigmZeta, sigmZetaNu)
+        hiddenStates.append(state)
+    return torch.stack(hiddenStates)
+
+@torch.jit.script
+def fastgrnn_unroll_lr(wComps, state, U1, U2, bias_gate, bias_update,
+                       sigmZeta, sigmZetaNu):
+    '''
+    fastgrnn_unroll for a low rank U = matmul(U1, U2)
+    '''
+    hiddenStates = []
+    for t in range(wComps.size(0)):
+        uComp = torch.matmul(torch.matmul(state, U1), U2)
+        state = fastgrnn_step(wComps[t], uComp, state,
+                              bias_gate, bias_update, sigmZeta, sigmZetaNu)
+        hiddenStates.append(state)
+    return torch.stack(hiddenStates)
+
+@torch.jit.script
+def gru_update(pre_comp3, z, state):
+    '''
+    Scripted tail of a GRU step for the tanh update nonlinearity, fusing the
+    candidate state and the gate blend into one kernel
+    '''
+    c = torch.tanh(pre_comp3)
+    return torch.lerp(c, state, z)
+
+@torch.jit.script
+def ugrnn_step(pre_comp1, pre_comp2, state):
+    '''
+    Scripted UGRNN update for the default sigmoid/tanh nonlinearities so
+    that the pointwise ops of a timestep run as a single fused kernel
+    '''
+    z = torch.sigmoid(pre_comp1)
+    c = torch.tanh(pre_comp2)
+    return torch.lerp(c, state, z)
+
+@torch.jit.script
+def gru_unroll(wComps, state, U, U12, U3, lowRank: bool):
+    '''
+    Scripted GRU recurrence for the sigmoid/tanh nonlinearities over time
+    major input projections wComps of shape [timeSteps, batchSize,
+    3 * hidden_size], with the biases already added. U12 = [U1|U2]; when
+    lowRank the state is first projected through U, which is otherwise
+    unused
+    '''
+    hidden = U3.size(1)
+    hiddenStates = []
+    for t in range(wComps.size(0)):
+        wComp = wComps[t]
+        stateU = torch.matmul(state, U) if lowRank else state
+        pre_comp12 = torch.addmm(wComp.narrow(1, 0, 2 * hidden), stateU, U12)
+        r = torch.sigmoid(pre_comp12.narrow(1, 0, hidden))
+        z = torch.sigmoid(pre_comp12.narrow(1, hidden, hidden))
+        rState = torch.matmul(r * state, U) if lowRank else r * state
+        pre_comp3 = torch.addmm(wComp.narrow(1, 2 * hidden, hidden),
+                                rState, U3)
+        state = gru_update(pre_comp3, z, state)
+        hiddenStates.append(state)
+    return torch.stack(hiddenStates)
+
+@torch.jit.script
+def ugrnn_unroll(wComps, state, U, U12, lowRank: bool):
+    '''
+    Scripted UGRNN recurrence for the sigmoid/tanh nonlinearities over time
+    major input projections wComps of shape [timeSteps, batchSize,
+    2 * hidden_size], with the biases already added. U12 = [U1|U2]; when
+    lowRank the state is first projected through U, which is otherwise
+    unused
+    '''
+    hidden = U12.size(1) // 2
+    hiddenStates = []
+    for t in range(wComps.size(0)):
+        stateU = torch.matmul(state, U) if lowRank else state
+        pre_comp = torch.addmm(wComps[t], stateU, U12)
+        state = ugrnn_step(pre_comp.narrow(1, 0, hidden),
+                           pre_comp.narrow(1, hidden, hidden), state)
+        hiddenStates.append(state)
+    return torch.stack(hiddenStates)
+
+def _numba_applicable(cell, input):
+    '''
+    Whether the numba kernels of _rnn_numba can run the recurrence of cell
+    '''
+    return (cell._use_numba and _rnn_numba.AVAILABLE and
+            cell._infer_dtype is None and
+            input.device.type == "cpu" and
+            input.dtype in (torch.float32, torch.float64) and
+            cell.state_size <= _rnn_numba.MAX_HIDDEN_SIZE and
+            cell.gate_nonlinearity == "sigmoid" and
+            cell.update_nonlinearity == "tanh")
+
+def _to_numpy(tensor):
+    return np.ascontiguousarray(tensor.detach().numpy())
+
+def _fastgrnn_step_eager(wComp, uComp, state, bias_gate, bias_update,
+                         sigmZeta, sigmZetaNu, gate_fn, update_fn):
+    pre_comp = wComp + uComp
+    z = gate_fn(pre_comp + bias_gate)
+    c = update_fn(pre_comp + bias_update)
+    return z * (state - sigmZeta * c) + sigmZetaNu * c
+
+_compiled_fastgrnn_steps = {}
+
+def _compiled_fastgrnn_step(mode):
+    '''
+    Returns _fastgrnn_step_eager compiled with torch.compile, shared by all
+    the cells using the same mode
+    '''
+    if not hasattr(torch, "compile"):
+        raise RuntimeError("torch.compile requires PyTorch 2.0 or later")
+    if mode not in _compiled_fastgrnn_steps:
+        # Shapes are specialised on first use; a change of batch size makes
+        # dynamo recompile once with the batch dimension marked dynamic
+        _compiled_fastgrnn_steps[mode] = torch.compile(
+            _fastgrnn_step_eager, mode=mode)
+    return _compiled_fastgrnn_steps[mode]
+
+
+def _gate_property(packed, gate):
+    '''
+    Property exposing one gate matrix of the parameter named packed, which
+    holds the matrices of all gates side by side, as a view
+    '''
+    return property(lambda self: self._gate_view(getattr(self, packed), gate))
 
 
 class RNNCell(nn.Module):
+    # Parameters holding the matrices of several gates side by side, mapped
+    # to the names of those gates in order. Checkpoints prior to version 2
+    # of such cells hold the gates as separate parameters
+    _packed_gates = {}
+
     def __init__(self, input_size, hidden_size,
                  gate_nonlinearity, update_nonlinearity,
                  num_W_matrices, num_U_matrices, num_biases,
@@ -74,6 +328,10 @@ class RNNCell(nn.Module):
         self._hidden_size = hidden_size
         self._gate_nonlinearity = gate_nonlinearity
         self._update_nonlinearity = update_nonlinearity
+        # The nonlinearities are fixed at construction, so the string lookup
+        # is done once here rather than at every timestep
+        self._gate_fn = resolve_nonlinearity(gate_nonlinearity)
+        self._update_fn = resolve_nonlinearity(update_nonlinearity)
         self._num_W_matrices = num_W_matrices
         self._num_U_matrices = num_U_matrices
         self._num_biases = num_biases
@@ -83,8 +341,14 @@ class RNNCell(nn.Module):
         self._uRank = uRank
         self._wSparsity = wSparsity
         self._uSparsity = uSparsity
-        self.oldmats = []
-
+        self._model_size_cache = None
+        self._infer_dtype = None
+        self._derived_cache = {}
+        self._script_unroll = False
+        self._use_scratch = False
+        self._use_numba = False
+        self._use_fused_kernel = False
+        self._scratch_buffers = {}
 
     @property
     def state_size(self):
@@ -129,56 +393,253 @@ class RNNCell(nn.Module):
     def forward(self, input, state):
         raise NotImplementedError()
 
+    def precompute_input(self, input):
+        '''
+        Returns the input side projections (Wx) of the cell. The input can
+        have any number of leading dimensions, which lets BaseRNN project
+        all the timesteps of a sequence with a single matmul before the
+        recurrence. Cells which do not override this get their raw input
+        back in forward_from_wx
+        '''
+        return input
+
+    def precompute_constants(self):
+        '''
+        Returns a tuple of tensors that depend only on the parameters of the
+        cell and are used at every timestep. BaseRNN computes them once per
+        sequence and passes them on to forward_from_wx
+        '''
+        return ()
+
+    def forward_from_wx(self, wComp, state):
+        '''
+        Single step of the cell given the output of precompute_input for
+        that timestep
+        '''
+        return self.forward(wComp, state)
+
     def getVars(self):
         raise NotImplementedError()
 
+    def _gate_view(self, mat, gate, gates=1):
+        return mat.narrow(1, gate * self._hidden_size,
+                          gates * self._hidden_size)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata,
+                              strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Stack the separate gate matrices of older checkpoints into the
+        # packed parameters
+        version = local_metadata.get("version", None)
+        if version is None or version < 2:
+            for packed, names in self._packed_gates.items():
+                keys = [prefix + name for name in names]
+                if all(key in state_dict for key in keys):
+                    state_dict[prefix + packed] = torch.cat(
+                        [state_dict.pop(key) for key in keys], dim=1)
+        super(RNNCell, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict,
+            missing_keys, unexpected_keys, error_msgs)
+
+    def script_unroll(self, enable=True):
+        '''
+        Makes BaseRNN run the whole recurrence through the scripted_unroll
+        of the cell, a single TorchScript loop, instead of calling
+        forward_from_wx from Python at every timestep. Has no effect for
+        cells or nonlinearities without a scripted unroll
+        '''
+        self._script_unroll = enable
+
+    def train(self, mode=True):
+        self._derived_cache = {}
+        return super(RNNCell, self).train(mode)
+
+    def _drop_caches(self):
+        self._derived_cache = {}
+        self._scratch_buffers = {}
+        self._model_size_cache = None
+        if getattr(self, "_sparse", None) is not None:
+            self._sparse.clear()
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to(), .cuda(), .half() etc. replace the parameter storage, and a
+        # freed pointer can come back with the same version counter, so
+        # nothing derived from the old weights is kept across them
+        self._drop_caches()
+        return super(RNNCell, self)._apply(fn, *args, **kwargs)
+
+    def _derived(self, name, sources, compute):
+        '''
+        Returns compute(), a tensor derived from the parameters in sources
+        for use without gradients, cached under name until one of the
+        sources is replaced or modified in place, or train() is called
+        '''
+        key = _weights_key(sources)
+        cached = self._derived_cache.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, compute())
+            self._derived_cache[name] = cached
+        return cached[1]
+
+    def use_numba(self, enable=True):
+        '''
+        Lets cells with a numba kernel (GRULR and UGRNNLR, sigmoid/tanh, on
+        the CPU) run the recurrence in it when gradients are off. Needs
+        numba; the first call pays for the JIT compilation. The results
+        match the PyTorch loop up to floating point rounding
+        '''
+        self._use_numba = enable
+
+    def use_fused_kernel(self, enable=True):
+        '''
+        Lets cells with a fused CUDA kernel (FastGRNN, with the fastgrnn_cuda
+        extension built) run the whole recurrence in it on the GPU when
+        gradients are off. Has no effect together with compile_step,
+        use_scratch or compile_sparse, whose paths are kept instead
+        '''
+        self._use_fused_kernel = enable
+
+    def use_scratch(self, enable=True):
+        '''
+        Makes the cell write the recurrent GEMM of every step into buffers
+        kept on the cell when running without gradients, instead of
+        allocating new outputs at each timestep. The buffers are shared by
+        all callers of the cell, so this is not thread-safe: a model with it
+        enabled must not run inference from several threads at once
+        '''
+        self._use_scratch = enable
+        self._scratch_buffers = {}
+
+    def _scratch(self, name, like, cols):
+        '''
+        Returns a [like.shape[0], cols] buffer for the intermediate name of
+        a step, reused across timesteps and sequences when use_scratch is on.
+        Returns None when gradients are enabled, as autograd needs the
+        intermediates of every step, and under autocast, which does not
+        apply to ops given an out tensor
+        '''
+        if not self._use_scratch or torch.is_grad_enabled() or \
+                torch.is_autocast_enabled():
+            return None
+        rows = like.shape[0]
+        # Buffers created under inference_mode are inference tensors which
+        # can not be written outside of it, so each mode has its own
+        name = (name, torch.is_inference_mode_enabled())
+        buf = self._scratch_buffers.get(name)
+        # Batches that shrink over time, as with packed sequences, use the
+        # leading rows of the buffer
+        if buf is None or buf.shape[0] < rows or buf.shape[1] != cols or \
+                buf.dtype != like.dtype or buf.device != like.device:
+            buf = like.new_empty([rows, cols])
+            self._scratch_buffers[name] = buf
+        return buf[:rows]
+
+    def _low_rank_matmul(self, name, input, first, second, add=None,
+                         sources=None, out=None):
+        '''
+        matmul(matmul(input, first), second) (+ add). In eval mode with
+        gradients off, the product of the two factors is cached under name
+        and applied as a single GEMM, trading the extra flops of the folded
+        matrix for one less kernel per step. The cache is dropped on train()
+        and whenever one of the sources (the factors by default; pass the
+        parameters when a factor is itself derived) is replaced or modified
+        in place
+        '''
+        if self.training or torch.is_grad_enabled():
+            input, mat = _gemm(input, first), second
+        else:
+            mat = self._derived(name, sources or [first, second],
+                                lambda: torch.matmul(first, second))
+        return _gemm(input, mat, add=add, out=out)
+
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        '''
+        Casts the weight matrices once to a reduced precision dtype
+        (bfloat16 or float16) for inference. Only the GEMM operands are
+        taken in that precision and their products are upcast: the biases,
+        gate pre-activations and states stay in float32, so the rounding
+        does not build up over long sequences. BaseRNN returns outputs in
+        the dtype of its input. dtype=None goes back to float32 weights
+        '''
+        self.float()
+        if dtype is not None:
+            # getVars can return views (transposes, gates of a packed
+            # matrix), so the parameters behind them are the ones cast
+            mats = self.getVars()[:self._num_W_matrices +
+                                  self._num_U_matrices]
+            bases = {id(mat if mat._base is None else mat._base)
+                     for mat in mats}
+            for param in self.parameters():
+                if id(param) in bases:
+                    param.data = param.data.to(dtype)
+            self._drop_caches()
+        self._infer_dtype = dtype
+        return self
+
     def get_model_size(self):
         '''
 		Function to get aimed model size
 		'''
         mats = self.getVars()
+        # Reuse the last count while none of the weights have been replaced
+        # or modified in place since
+        key = _weights_key(mats)
+        if self._model_size_cache is not None and \
+                self._model_size_cache[0] == key:
+            return self._model_size_cache[1]
         endW = self._num_W_matrices
         endU = endW + self._num_U_matrices
 
         totalnnz = 2  # For Zeta and Nu
         for i in range(0, endW):
-            device = mats[i].device
-            totalnnz += utils.countNNZ(mats[i].cpu(), self._wSparsity)
-            mats[i].to(device)
+            totalnnz += utils.countNNZ(mats[i], self._wSparsity)
         for i in range(endW, endU):
-            device = mats[i].device
-            totalnnz += utils.countNNZ(mats[i].cpu(), self._uSparsity)
-            mats[i].to(device)
+            totalnnz += utils.countNNZ(mats[i], self._uSparsity)
         for i in range(endU, len(mats)):
-            device = mats[i].device
-            totalnnz += utils.countNNZ(mats[i].cpu(), False)
-            mats[i].to(device)
+            totalnnz += utils.countNNZ(mats[i], False)
+        self._model_size_cache = (key, totalnnz * 4)
         return totalnnz * 4
 
+    @property
+    def oldmats(self):
+        num_mats = self._num_W_matrices + self._num_U_matrices
+        return [self._buffers["oldmat_" + str(i)] for i in range(num_mats)
+                if "oldmat_" + str(i) in self._buffers]
+
     def copy_previous_UW(self):
         mats = self.getVars()
         num_mats = self._num_W_matrices + self._num_U_matrices
-        if len(self.oldmats) != num_mats:
-            for i in range(num_mats):
-                self.oldmats.append(torch.FloatTensor())
+        # Snapshots stay on the device of the weights and, as non persistent
+        # buffers, follow the module across .to() without being checkpointed
         for i in range(num_mats):
-            self.oldmats[i] = torch.FloatTensor(mats[i].detach().clone().to(mats[i].device))
+            self.register_buffer("oldmat_" + str(i),
+                                 mats[i].detach().clone(), persistent=False)
 
     def sparsify(self):
         mats = self.getVars()
         endW = self._num_W_matrices
         endU = endW + self._num_U_matrices
-        for i in range(0, endW):
-            mats[i] = utils.hardThreshold(mats[i], self._wSparsity)
-        for i in range(endW, endU):
-            mats[i] = utils.hardThreshold(mats[i], self._uSparsity)
+        # getVars can return views into a packed parameter (W_ifco, W_all),
+        # so the thresholded values are written back in place rather than
+        # rebinding the list entries. Writing through the tensor rather than
+        # .data also bumps the version counters the caches are keyed on
+        with torch.no_grad():
+            for i in range(0, endW):
+                mats[i].copy_(utils.hardThreshold(mats[i], self._wSparsity))
+            for i in range(endW, endU):
+                mats[i].copy_(utils.hardThreshold(mats[i], self._uSparsity))
+        self._model_size_cache = None
         self.copy_previous_UW()
 
     def sparsifyWithSupport(self):
         mats = self.getVars()
         endU = self._num_W_matrices + self._num_U_matrices
-        for i in range(0, endU):
-            mats[i] = utils.supportBasedThreshold(mats[i], self.oldmats[i])
+        oldmats = self.oldmats
+        # In place, for the same reason as in sparsify
+        with torch.no_grad():
+            for i in range(0, endU):
+                mats[i].mul_((oldmats[i] != 0).to(mats[i].dtype))
+        self._model_size_cache = None
 
 class FastGRNNCell(RNNCell):
     '''
@@ -187,9 +648,10 @@ class FastGRNNCell(RNNCell):
     hidden_size = # hidden units
 
     gate_nonlinearity = nonlinearity for the gate can be chosen from
-    [tanh, sigmoid, relu, quantTanh, quantSigm]
+    [tanh, sigmoid, relu, quantTanh, quantSigm, hardSigm, hardTanh]
     update_nonlinearity = nonlinearity for final rnn update
-    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm]
+    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm,
+    hardSigm, hardTanh]
 
     wRank = rank of W matrix (creates two matrices if not None)
     uRank = rank of U matrix (creates two matrices if not None)
@@ -214,12 +676,22 @@ class FastGRNNCell(RNNCell):
 
     W and U can further parameterised into low rank version by
     W = matmul(W_1, W_2) and U = matmul(U_1, U_2)
+
+    W and U are stored as [in, out] like FastRNNCell; checkpoints using the
+    older [out, in] layout are transposed on load. Those are recognised by
+    the version recorded in the state dict metadata. A state dict without
+    metadata (e.g. rebuilt as a plain dict) has its layout inferred from the
+    shapes of W, U and their factors, and loading it raises a ValueError
+    when all of them are square so that both layouts fit
     '''
 
+    # Version 2 stores W, U and their low rank factors as [in, out]
+    _version = 2
+
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
                  wSparsity=1.0, uSparsity=1.0, zetaInit=1.0, nuInit=-4.0,
-                 name="FastGRNN"):
+                 name="FastGRNN", device=None, dtype=None):
         super(FastGRNNCell, self).__init__(input_size, hidden_size,
                                           gate_nonlinearity, update_nonlinearity,
                                           1, 1, 2, wRank, uRank, wSparsity,
@@ -234,25 +706,71 @@ class FastGRNNCell(RNNCell):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": device, "dtype": dtype}
         if wRank is None:
-            self.W = nn.Parameter(0.1 * torch.randn([hidden_size, input_size]))
+            self.W = _normal_param([input_size, hidden_size], factory_kwargs)
         else:
-            self.W1 = nn.Parameter(0.1 * torch.randn([wRank, input_size]))
-            self.W2 = nn.Parameter(0.1 * torch.randn([hidden_size, wRank]))
+            self.W1 = _normal_param([input_size, wRank], factory_kwargs)
+            self.W2 = _normal_param([wRank, hidden_size], factory_kwargs)
 
         if uRank is None:
-            self.U = nn.Parameter(0.1 * torch.randn([hidden_size, hidden_size]))
+            self.U = _normal_param([hidden_size, hidden_size], factory_kwargs)
         else:
-            self.U1 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U2 = nn.Parameter(0.1 * torch.randn([hidden_size, uRank]))
+            self.U1 = _normal_param([hidden_size, uRank], factory_kwargs)
+            self.U2 = _normal_param([uRank, hidden_size], factory_kwargs)
 
-        self.bias_gate = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_update = nn.Parameter(torch.ones([1, hidden_size]))
-        self.zeta = nn.Parameter(self._zetaInit * torch.ones([1, 1]))
-        self.nu = nn.Parameter(self._nuInit * torch.ones([1, 1]))
+        self.bias_gate = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_update = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.zeta = _const_param([1, 1], self._zetaInit, factory_kwargs)
+        self.nu = _const_param([1, 1], self._nuInit, factory_kwargs)
+
+        self._scripted = (gate_nonlinearity == "sigmoid" and
+                          update_nonlinearity == "tanh")
+        self._compiled = False
+        self._compile_mode = None
+        self._sparse = None
 
         self.copy_previous_UW()
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata,
+                              strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Checkpoints prior to version 2 stored W, U and their low rank
+        # factors as [out, in]; transpose them to the current [in, out] layout
+        names = [name for name in ["W", "W1", "W2", "U", "U1", "U2"]
+                 if prefix + name in state_dict and
+                 isinstance(getattr(self, name, None), nn.Parameter)]
+        version = local_metadata.get("version", None)
+        if version is None:
+            legacy = self._infer_legacy_layout(state_dict, prefix, names)
+        else:
+            legacy = version < 2
+        if legacy:
+            for name in names:
+                state_dict[prefix + name] = state_dict[prefix + name].t()
+        super(FastGRNNCell, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict,
+            missing_keys, unexpected_keys, error_msgs)
+
+    def _infer_legacy_layout(self, state_dict, prefix, names):
+        '''
+        Whether a state dict without version metadata holds W, U and their
+        factors in the [out, in] layout of version 1, told apart by shape
+        '''
+        shapes = [(tuple(state_dict[prefix + name].shape),
+                   tuple(getattr(self, name).shape)) for name in names]
+        current = all(saved == own for saved, own in shapes)
+        legacy = all(saved == own[::-1] for saved, own in shapes)
+        if current and legacy and shapes:
+            raise ValueError(
+                "Can not tell the layout of " + ", ".join(names) +
+                " in a state dict without version metadata as they are " +
+                "square; load it through state_dict()/torch.save of the " +
+                "module, or transpose [out, in] checkpoints before loading")
+        # When neither layout fits, the size mismatch is reported by the
+        # regular loading
+        return legacy and not current
+
     @property
     def name(self):
         return self._name
@@ -261,45 +779,378 @@ class FastGRNNCell(RNNCell):
     def cellType(self):
         return "FastGRNN"
 
-    def forward(self, input, state):
+    def precompute_input(self, input):
+        if self._sparse is not None and self._use_sparse(self._wSparsity):
+            if self._wRank is None:
+                return self._sparse_matmul(input, "W")
+            return self._sparse_matmul(self._sparse_matmul(input, "W1"), "W2")
         if self._wRank is None:
-            wComp = torch.matmul(input, torch.transpose(self.W, 0, 1))
+            return _gemm(input, self.W)
         else:
-            wComp = torch.matmul(
-                torch.matmul(input, torch.transpose(self.W1, 0, 1)), torch.transpose(self.W2, 0, 1))
+            return _gemm(_gemm(input, self.W1), self.W2)
 
-        if self._uRank is None:
-            uComp = torch.matmul(state, torch.transpose(self.U, 0, 1))
+    def forward(self, input, state):
+        return self.forward_from_wx(self.precompute_input(input), state)
+
+    def compile_sparse(self, enable=True):
+        '''
+        Keeps CSR copies of the W and U matrices whose intended sparsity is
+        below 1 and multiplies through them with torch.sparse.mm in eval
+        mode with gradients off. The dense parameters are still the ones
+        trained; the CSR copies are rebuilt when they change. Only pays off
+        once the matrices have been hard thresholded with sparsify
+        '''
+        self._sparse = {} if enable else None
+
+    def _use_sparse(self, sparsity):
+        return sparsity < 1.0 and self._infer_dtype is None and \
+            not self.training and \
+            not torch.is_grad_enabled() and \
+            not torch.onnx.is_in_onnx_export()
+
+    def _sparse_matmul(self, input, name):
+        '''
+        matmul(input, getattr(self, name)) through the CSR copy of the
+        matrix, for input with any number of leading dimensions
+        '''
+        mat = getattr(self, name)
+        key = _weights_key([mat])
+        cached = self._sparse.get(name)
+        if cached is None or cached[0] != key:
+            # CSR rows are the outputs, so the copy is kept as [out, in]
+            cached = (key, mat.detach().t().contiguous().to_sparse_csr())
+            self._sparse[name] = cached
+        flat = input.reshape(-1, input.shape[-1])
+        out = torch.sparse.mm(cached[1], flat.t()).t()
+        return out.reshape(input.shape[:-1] + (mat.shape[1],))
+
+    def compile_step(self, mode=None, enable=True):
+        '''
+        Runs the pointwise part of every step through torch.compile, which
+        fuses the bias adds, nonlinearities and update into one kernel.
+        Needs PyTorch 2.0. The "reduce-overhead" mode is not suitable as
+        its CUDA graph outputs are overwritten by the following step
+        '''
+        if enable:
+            _compiled_fastgrnn_step(mode)
+        self._compiled = enable
+        self._compile_mode = mode
+
+    def precompute_constants(self):
+        sigmZeta = torch.sigmoid(self.zeta)
+        return (sigmZeta, sigmZeta + torch.sigmoid(self.nu))
+
+    def forward_from_wx(self, wComp, state, sigmZeta=None, sigmZetaNu=None):
+        if sigmZeta is None:
+            sigmZeta, sigmZetaNu = self.precompute_constants()
+        if self._sparse is not None and self._use_sparse(self._uSparsity):
+            if self._uRank is None:
+                uComp = self._sparse_matmul(state, "U")
+            else:
+                uComp = self._sparse_matmul(
+                    self._sparse_matmul(state, "U1"), "U2")
+        elif self._uRank is None:
+            uComp = _gemm(
+                state, self.U,
+                out=self._scratch("uComp", state, self._hidden_size))
         else:
-            uComp = torch.matmul(
-                torch.matmul(state, torch.transpose(self.U1, 0, 1)), torch.transpose(self.U2, 0, 1))
+            uComp = self._low_rank_matmul(
+                "U", state, self.U1, self.U2,
+                out=self._scratch("uComp", state, self._hidden_size))
 
-        pre_comp = wComp + uComp
-        z = gen_nonlinearity(pre_comp + self.bias_gate,
-                              self._gate_nonlinearity)
-        c = gen_nonlinearity(pre_comp + self.bias_update,
-                              self._update_nonlinearity)
-        new_h = z * state + (torch.sigmoid(self.zeta) *
-                             (1.0 - z) + torch.sigmoid(self.nu)) * c
+        if self._compiled:
+            return _compiled_fastgrnn_step(self._compile_mode)(
+                wComp, uComp, state, self.bias_gate, self.bias_update,
+                sigmZeta, sigmZetaNu, self._gate_fn, self._update_fn)
 
-        return new_h
+        if self._scripted:
+            return fastgrnn_step(wComp, uComp, state, self.bias_gate,
+                                 self.bias_update, sigmZeta, sigmZetaNu)
+
+        return _fastgrnn_step_eager(wComp, uComp, state, self.bias_gate,
+                                    self.bias_update, sigmZeta, sigmZetaNu,
+                                    self._gate_fn, self._update_fn)
+
+    def fused_unroll(self, input, state):
+        '''
+        Runs the whole recurrence over time major input with the
+        forward_unroll kernel of the fastgrnn_cuda extension, which keeps the
+        time loop on the C++ side. Returns None unless use_fused_kernel is
+        on, the extension is built, the input, state and parameters are
+        float32 or float64 tensors of one dtype on the GPU and the
+        nonlinearities are supported by the kernel, or when one of
+        compile_step, use_scratch, compile_sparse or to_bf16_inference is on
+        '''
+        if not self._use_fused_kernel or fastgrnn_cuda is None or \
+                not input.is_cuda or \
+                self._compiled or self._use_scratch or \
+                self._sparse is not None or self._infer_dtype is not None or \
+                input.dtype not in (torch.float32, torch.float64) or \
+                state.dtype != input.dtype or \
+                any(param.dtype != input.dtype
+                    for param in self.parameters()) or \
+                self._update_nonlinearity != "tanh" or \
+                self._gate_nonlinearity not in _CUDA_GATE_NONLINEARITIES:
+            return None
+        # The kernel takes the matrices in the [out, in] layout. The
+        # transposed copies are kept between calls rather than redone on
+        # every sequence
+        def kernelLayout(name):
+            mat = getattr(self, name)
+            return self._derived("kernel_" + name, [mat],
+                                 lambda: mat.detach().t().contiguous())
+        empty = input.new_empty(0)
+        if self._wRank is None:
+            w, w1, w2 = kernelLayout("W"), empty, empty
+        else:
+            w, w1, w2 = empty, kernelLayout("W1"), kernelLayout("W2")
+        if self._uRank is None:
+            u, u1, u2 = kernelLayout("U"), empty, empty
+        else:
+            u, u1, u2 = empty, kernelLayout("U1"), kernelLayout("U2")
+        return fastgrnn_cuda.forward_unroll(
+            input.contiguous(), w, u, self.bias_gate, self.bias_update,
+            self.zeta, self.nu, state.contiguous(),
+            _CUDA_GATE_NONLINEARITIES[self._gate_nonlinearity],
+            w1, w2, u1, u2)[0]
+
+    def scripted_unroll(self, wComps, state, sigmZeta, sigmZetaNu):
+        '''
+        Runs the whole recurrence over time major wComps in TorchScript.
+        Returns None when the nonlinearities can not be scripted
+        '''
+        if not self._scripted:
+            return None
+        if self._uRank is None:
+            return fastgrnn_unroll(wComps, state, self.U, self.bias_gate,
+                                   self.bias_update, sigmZeta, sigmZetaNu)
+        return fastgrnn_unroll_lr(wComps, state, self.U1, self.U2,
+                                  self.bias_gate, self.bias_update,
+                                  sigmZeta, sigmZetaNu)
 
     def getVars(self):
+        # The parameters are stored [in, out] for the forward matmuls, but
+        # getVars keeps handing out the [out, in] layout that saveParams,
+        # the ONNX export and the C code read. The transposes are views, so
+        # in place updates through them still reach the parameters
         Vars = []
         if self._num_W_matrices == 1:
-            Vars.append(self.W)
+            Vars.append(self.W.t())
         else:
-            Vars.extend([self.W1, self.W2])
+            Vars.extend([self.W1.t(), self.W2.t()])
 
         if self._num_U_matrices == 1:
-            Vars.append(self.U)
+            Vars.append(self.U.t())
         else:
-            Vars.extend([self.U1, self.U2])
+            Vars.extend([self.U1.t(), self.U2.t()])
+
+        Vars.extend([self.bias_gate, self.bias_update])
+        Vars.extend([self.zeta, self.nu])
+        return Vars
+
+class FastGRNNCellInt8(RNNCell):
+    '''
+    INT8 inference version of FastGRNNCell
+
+    W and U (or their low rank factors) are quantized symmetrically per
+    tensor to int8 and the matmuls run through PyTorch's dynamically
+    quantized linear kernels (FBGEMM/QNNPACK), which quantize the
+    activations on the fly. The gate and update nonlinearities are evaluated
+    with lutSize entry lookup tables over a calibrated pre-activation range;
+    pre-activations outside the range saturate.
+
+    The cell can only be used for CPU inference and is built from a trained
+    FastGRNNCell using FastGRNNCellInt8.from_float
+    '''
+
+    def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
+                 update_nonlinearity="tanh", wRank=None, uRank=None,
+                 lutSize=256, name="FastGRNNInt8"):
+        super(FastGRNNCellInt8, self).__init__(input_size, hidden_size,
+                                               gate_nonlinearity,
+                                               update_nonlinearity,
+                                               1, 1, 2, wRank, uRank)
+        if wRank is not None:
+            self._num_W_matrices += 1
+            self._num_weight_matrices[0] = self._num_W_matrices
+        if uRank is not None:
+            self._num_U_matrices += 1
+            self._num_weight_matrices[1] = self._num_U_matrices
+        self._name = name
+        self._lutSize = lutSize
+
+        # Quantized matrices are kept as [out, in] like nn.Linear
+        if wRank is None:
+            self._w_names = ["W"]
+            shapes = [[hidden_size, input_size]]
+        else:
+            self._w_names = ["W1", "W2"]
+            shapes = [[wRank, input_size], [hidden_size, wRank]]
+        if uRank is None:
+            self._u_names = ["U"]
+            shapes += [[hidden_size, hidden_size]]
+        else:
+            self._u_names = ["U1", "U2"]
+            shapes += [[uRank, hidden_size], [hidden_size, uRank]]
+        for matName, shape in zip(self._w_names + self._u_names, shapes):
+            self.register_buffer(matName + "_q",
+                                 torch.zeros(shape, dtype=torch.int8))
+            self.register_buffer(matName + "_scale", torch.ones([]))
+
+        self.register_buffer("bias_gate", torch.ones([1, hidden_size]))
+        self.register_buffer("bias_update", torch.ones([1, hidden_size]))
+        self.register_buffer("zeta", torch.ones([1, 1]))
+        self.register_buffer("nu", torch.ones([1, 1]))
+
+        self.register_buffer("gate_table", torch.zeros([lutSize]))
+        self.register_buffer("gate_bounds", torch.zeros([2]))
+        self.register_buffer("update_table", torch.zeros([lutSize]))
+        self.register_buffer("update_bounds", torch.zeros([2]))
+        self.setLUTBounds([-8.0, 8.0], [-8.0, 8.0])
+
+        self._packed_params = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def cellType(self):
+        return "FastGRNNInt8"
+
+    @classmethod
+    def from_float(cls, cell, calibration_input=None, batch_first=True,
+                   lutSize=256):
+        '''
+        Quantizes a trained FastGRNNCell
+
+        calibration_input = representative batch of sequences, used to set
+        the lookup table ranges to the observed gate and update
+        pre-activations (like static quantization calibration). The tables
+        span [-8, 8] otherwise
+        '''
+        qcell = cls(cell.input_size, cell.state_size,
+                    gate_nonlinearity=cell.gate_nonlinearity,
+                    update_nonlinearity=cell.update_nonlinearity,
+                    wRank=cell.wRank, uRank=cell.uRank, lutSize=lutSize)
+        with torch.no_grad():
+            for matName in qcell._w_names + qcell._u_names:
+                mat = getattr(cell, matName).detach().cpu().t()
+                scale = mat.abs().max().clamp(min=1e-8) / 127.0
+                getattr(qcell, matName + "_q").copy_(
+                    torch.clamp(torch.round(mat / scale), -127, 127))
+                getattr(qcell, matName + "_scale").fill_(scale.item())
+            for varName in ["bias_gate", "bias_update", "zeta", "nu"]:
+                getattr(qcell, varName).copy_(getattr(cell, varName))
+
+            if calibration_input is not None:
+                qcell.setLUTBounds(*cls._calibrate(cell, calibration_input,
+                                                   batch_first))
+        return qcell
+
+    @staticmethod
+    def _calibrate(cell, input, batch_first):
+        timeDim = 1 if batch_first else 0
+        wComps = cell.precompute_input(input)
+        consts = cell.precompute_constants()
+        state = torch.zeros([wComps.shape[1 - timeDim], cell.state_size],
+                            device=wComps.device)
+        gateBounds = [float("inf"), -float("inf")]
+        updateBounds = [float("inf"), -float("inf")]
+        for wComp in wComps.unbind(timeDim):
+            if cell.uRank is None:
+                uComp = torch.matmul(state, cell.U)
+            else:
+                uComp = torch.matmul(torch.matmul(state, cell.U1), cell.U2)
+            pre_comp = wComp + uComp
+            for bounds, bias in [(gateBounds, cell.bias_gate),
+                                 (updateBounds, cell.bias_update)]:
+                bounds[0] = min(bounds[0], (pre_comp + bias).min().item())
+                bounds[1] = max(bounds[1], (pre_comp + bias).max().item())
+            state = cell.forward_from_wx(wComp, state, *consts)
+        return gateBounds, updateBounds
+
+    def setLUTBounds(self, gateBounds, updateBounds):
+        '''
+        Rebuilds the gate and update lookup tables over the given [lo, hi]
+        '''
+        for prefix, bounds, nonlinearity in [
+                ("gate", gateBounds, self._gate_nonlinearity),
+                ("update", updateBounds, self._update_nonlinearity)]:
+            lo, hi = float(bounds[0]), float(bounds[1])
+            if hi - lo < 1e-6:
+                lo, hi = lo - 1.0, hi + 1.0
+            getattr(self, prefix + "_bounds").copy_(torch.tensor([lo, hi]))
+            getattr(self, prefix + "_table").copy_(gen_nonlinearity(
+                torch.linspace(lo, hi, self._lutSize), nonlinearity))
+
+    @staticmethod
+    def _lookup(A, table, bounds):
+        idx = torch.round((A - bounds[0]) *
+                          ((table.numel() - 1) / (bounds[1] - bounds[0])))
+        return torch.take(table, idx.clamp(0, table.numel() - 1).long())
+
+    def _project(self, input, matNames):
+        if self._packed_params is None:
+            self._packed_params = {}
+            for matName in self._w_names + self._u_names:
+                scale = getattr(self, matName + "_scale").item()
+                qmat = torch.quantize_per_tensor(
+                    getattr(self, matName + "_q").float() * scale, scale, 0,
+                    torch.qint8)
+                self._packed_params[matName] = \
+                    torch.ops.quantized.linear_prepack(qmat, None)
+        leadingShape = input.shape[:-1]
+        out = input.reshape(-1, input.shape[-1]).contiguous()
+        for matName in matNames:
+            out = torch.ops.quantized.linear_dynamic(
+                out, self._packed_params[matName])
+        return out.reshape(leadingShape + out.shape[-1:])
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(FastGRNNCellInt8, self)._load_from_state_dict(*args, **kwargs)
+        self._packed_params = None
+
+    def precompute_input(self, input):
+        return self._project(input, self._w_names)
+
+    def forward(self, input, state):
+        return self.forward_from_wx(self.precompute_input(input), state)
+
+    def precompute_constants(self):
+        sigmZeta = torch.sigmoid(self.zeta)
+        return (sigmZeta, sigmZeta + torch.sigmoid(self.nu))
+
+    def forward_from_wx(self, wComp, state, sigmZeta=None, sigmZetaNu=None):
+        if sigmZeta is None:
+            sigmZeta, sigmZetaNu = self.precompute_constants()
+        pre_comp = wComp + self._project(state, self._u_names)
+        z = self._lookup(pre_comp + self.bias_gate, self.gate_table,
+                         self.gate_bounds)
+        c = self._lookup(pre_comp + self.bias_update, self.update_table,
+                         self.update_bounds)
+        return z * (state - sigmZeta * c) + sigmZetaNu * c
 
+    def getVars(self):
+        Vars = [getattr(self, matName + "_q")
+                for matName in self._w_names + self._u_names]
         Vars.extend([self.bias_gate, self.bias_update])
         Vars.extend([self.zeta, self.nu])
         return Vars
 
+    def get_model_size(self):
+        '''
+        Function to get model size, int8 matrices take a byte per entry
+        '''
+        mats = self.getVars()
+        endU = self._num_W_matrices + self._num_U_matrices
+        size = 0
+        for i in range(0, endU):
+            size += mats[i].numel() + 4
+        for i in range(endU, len(mats)):
+            size += mats[i].numel() * 4
+        return size
+
 class FastGRNNCUDACell(RNNCell):
     '''
     A CUDA implementation of FastGRNN Cell with Full Rank Support
@@ -319,8 +1170,9 @@ class FastGRNNCUDACell(RNNCell):
 
     '''
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid", 
-    update_nonlinearity="tanh", wRank=None, uRank=None, zetaInit=1.0, nuInit=-4.0, wSparsity=1.0, uSparsity=1.0, name="FastGRNNCUDACell"):
-        super(FastGRNNCUDACell, self).__init__(input_size, hidden_size, gate_non_linearity, update_nonlinearity, 
+    update_nonlinearity="tanh", wRank=None, uRank=None, zetaInit=1.0, nuInit=-4.0, wSparsity=1.0, uSparsity=1.0, name="FastGRNNCUDACell",
+                 device=None, dtype=None):
+        super(FastGRNNCUDACell, self).__init__(input_size, hidden_size, gate_nonlinearity, update_nonlinearity, 
                                                 1, 1, 2, wRank, uRank, wSparsity, uSparsity)
         if utils.findCUDA() is None:
             raise Exception('FastGRNNCUDA is supported only on GPU devices.')
@@ -330,7 +1182,7 @@ class FastGRNNCUDACell(RNNCell):
         self._zetaInit = zetaInit
         self._nuInit = nuInit
         self._name = name
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda" if device is None else device)
 
         if wRank is not None:
             self._num_W_matrices += 1
@@ -340,30 +1192,31 @@ class FastGRNNCUDACell(RNNCell):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": self.device, "dtype": dtype}
         if wRank is None:
-            self.W = nn.Parameter(0.1 * torch.randn([hidden_size, input_size], self.device))
-            self.W1 = torch.empty(0)
-            self.W2 = torch.empty(0)
+            self.W = _normal_param([hidden_size, input_size], factory_kwargs)
+            self.W1 = torch.empty(0, **factory_kwargs)
+            self.W2 = torch.empty(0, **factory_kwargs)
         else:
-            self.W = torch.empty(0)
-            self.W1 = nn.Parameter(0.1 * torch.randn([wRank, input_size], self.device))
-            self.W2 = nn.Parameter(0.1 * torch.randn([hidden_size, wRank], self.device))
+            self.W = torch.empty(0, **factory_kwargs)
+            self.W1 = _normal_param([wRank, input_size], factory_kwargs)
+            self.W2 = _normal_param([hidden_size, wRank], factory_kwargs)
 
         if uRank is None:
-            self.U = nn.Parameter(0.1 * torch.randn([hidden_size, hidden_size], self.device))
-            self.U1 = torch.empty(0)
-            self.U2 = torch.empty(0)
+            self.U = _normal_param([hidden_size, hidden_size], factory_kwargs)
+            self.U1 = torch.empty(0, **factory_kwargs)
+            self.U2 = torch.empty(0, **factory_kwargs)
         else:
-            self.U = torch.empty(0)
-            self.U1 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size], self.device))
-            self.U2 = nn.Parameter(0.1 * torch.randn([hidden_size, uRank], self.device))
+            self.U = torch.empty(0, **factory_kwargs)
+            self.U1 = _normal_param([uRank, hidden_size], factory_kwargs)
+            self.U2 = _normal_param([hidden_size, uRank], factory_kwargs)
 
         self._gate_non_linearity = NON_LINEARITY[gate_nonlinearity]
 
-        self.bias_gate = nn.Parameter(torch.ones([1, hidden_size], self.device))
-        self.bias_update = nn.Parameter(torch.ones([1, hidden_size], self.device))
-        self.zeta = nn.Parameter(self._zetaInit * torch.ones([1, 1], self.device))
-        self.nu = nn.Parameter(self._nuInit * torch.ones([1, 1], self.device))
+        self.bias_gate = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_update = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.zeta = _const_param([1, 1], self._zetaInit, factory_kwargs)
+        self.nu = _const_param([1, 1], self._nuInit, factory_kwargs)
 
     @property
     def name(self):
@@ -404,7 +1257,8 @@ class FastRNNCell(RNNCell):
     hidden_size = # hidden units
 
     update_nonlinearity = nonlinearity for final rnn update
-    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm]
+    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm,
+    hardSigm, hardTanh]
 
     wRank = rank of W matrix (creates two matrices if not None)
     uRank = rank of U matrix (creates two matrices if not None)
@@ -433,7 +1287,7 @@ class FastRNNCell(RNNCell):
     def __init__(self, input_size, hidden_size,
                  update_nonlinearity="tanh", wRank=None, uRank=None,
                  wSparsity=1.0, uSparsity=1.0, alphaInit=-3.0, betaInit=3.0,
-                 name="FastRNN"):
+                 name="FastRNN", device=None, dtype=None):
         super(FastRNNCell, self).__init__(input_size, hidden_size,
                                            None, update_nonlinearity,
                                            1, 1, 1, wRank, uRank, wSparsity,
@@ -449,22 +1303,22 @@ class FastRNNCell(RNNCell):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": device, "dtype": dtype}
         if wRank is None:
-            self.W = nn.Parameter(0.1 * torch.randn([input_size, hidden_size]))
+            self.W = _normal_param([input_size, hidden_size], factory_kwargs)
         else:
-            self.W1 = nn.Parameter(0.1 * torch.randn([input_size, wRank]))
-            self.W2 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
+            self.W1 = _normal_param([input_size, wRank], factory_kwargs)
+            self.W2 = _normal_param([wRank, hidden_size], factory_kwargs)
 
         if uRank is None:
-            self.U = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
+            self.U = _normal_param([hidden_size, hidden_size], factory_kwargs)
         else:
-            self.U1 = nn.Parameter(0.1 * torch.randn([hidden_size, uRank]))
-            self.U2 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
+            self.U1 = _normal_param([hidden_size, uRank], factory_kwargs)
+            self.U2 = _normal_param([uRank, hidden_size], factory_kwargs)
 
-        self.bias_update = nn.Parameter(torch.ones([1, hidden_size]))
-        self.alpha = nn.Parameter(self._alphaInit * torch.ones([1, 1]))
-        self.beta = nn.Parameter(self._betaInit * torch.ones([1, 1]))
+        self.bias_update = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.alpha = _const_param([1, 1], self._alphaInit, factory_kwargs)
+        self.beta = _const_param([1, 1], self._betaInit, factory_kwargs)
 
     @property
     def name(self):
@@ -474,25 +1328,34 @@ class FastRNNCell(RNNCell):
     def cellType(self):
         return "FastRNN"
 
-    def forward(self, input, state):
+    def precompute_input(self, input):
+        # The update bias is folded into the input projection
         if self._wRank is None:
-            wComp = torch.matmul(input, self.W)
+            return _addmm_nd(self.bias_update, input, self.W)
         else:
-            wComp = torch.matmul(
-                torch.matmul(input, self.W1), self.W2)
+            return _addmm_nd(self.bias_update,
+                             _gemm(input, self.W1), self.W2)
 
+    def forward(self, input, state):
+        return self.forward_from_wx(self.precompute_input(input), state)
+
+    def precompute_constants(self):
+        return (torch.sigmoid(self.alpha), torch.sigmoid(self.beta))
+
+    def forward_from_wx(self, wComp, state, sigmAlpha=None, sigmBeta=None):
+        if sigmAlpha is None:
+            sigmAlpha, sigmBeta = self.precompute_constants()
         if self._uRank is None:
-            uComp = torch.matmul(state, self.U)
+            pre_comp = _gemm(
+                state, self.U, add=wComp,
+                out=self._scratch("pre_comp", state, self._hidden_size))
         else:
-            uComp = torch.matmul(
-                torch.matmul(state, self.U1), self.U2)
+            pre_comp = self._low_rank_matmul(
+                "U", state, self.U1, self.U2, add=wComp,
+                out=self._scratch("pre_comp", state, self._hidden_size))
 
-        pre_comp = wComp + uComp
-
-        c = gen_nonlinearity(pre_comp + self.bias_update,
-                              self._update_nonlinearity)
-        new_h = torch.sigmoid(self.beta) * state + \
-            torch.sigmoid(self.alpha) * c
+        c = self._update_fn(pre_comp)
+        new_h = sigmBeta * state + sigmAlpha * c
 
         return new_h
 
@@ -522,9 +1385,10 @@ class LSTMLRCell(RNNCell):
     hidden_size = # hidden units
 
     gate_nonlinearity = nonlinearity for the gate can be chosen from
-    [tanh, sigmoid, relu, quantTanh, quantSigm]
+    [tanh, sigmoid, relu, quantTanh, quantSigm, hardSigm, hardTanh]
     update_nonlinearity = nonlinearity for final rnn update
-    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm]
+    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm,
+    hardSigm, hardTanh]
 
     wRank = rank of all W matrices
     (creates 5 matrices if not None else creates 4 matrices)
@@ -545,11 +1409,21 @@ class LSTMLRCell(RNNCell):
 
     Wi and Ui can further parameterised into low rank version by
     Wi = matmul(W, W_i) and Ui = matmul(U, U_i)
+
+    W1..W4 (and U1..U4) are stored side by side in W_ifco (U_ifco) so that
+    all four gates are computed with a single matmul. W1..W4 and U1..U4
+    remain available as views into them
     '''
 
+    # Version 2 stores W1..W4 and U1..U4 concatenated in W_ifco and U_ifco
+    _version = 2
+    _packed_gates = {"W_ifco": ["W1", "W2", "W3", "W4"],
+                     "U_ifco": ["U1", "U2", "U3", "U4"]}
+
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, name="LSTMLR"):
+                 wSparsity=1.0, uSparsity=1.0, name="LSTMLR", device=None,
+                 dtype=None):
         super(LSTMLRCell, self).__init__(input_size, hidden_size,
                                           gate_nonlinearity, update_nonlinearity,
                                           4, 4, 4, wRank, uRank, wSparsity,
@@ -563,42 +1437,27 @@ class LSTMLRCell(RNNCell):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": device, "dtype": dtype}
         if wRank is None:
-            self.W1 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
-            self.W2 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
-            self.W3 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
-            self.W4 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
+            self.W_ifco = _normal_param([input_size, 4 * hidden_size],
+                                        factory_kwargs)
         else:
-            self.W = nn.Parameter(0.1 * torch.randn([input_size, wRank]))
-            self.W1 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
-            self.W2 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
-            self.W3 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
-            self.W4 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
+            self.W = _normal_param([input_size, wRank], factory_kwargs)
+            self.W_ifco = _normal_param([wRank, 4 * hidden_size],
+                                        factory_kwargs)
 
         if uRank is None:
-            self.U1 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
-            self.U2 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
-            self.U3 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
-            self.U4 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
+            self.U_ifco = _normal_param([hidden_size, 4 * hidden_size],
+                                        factory_kwargs)
         else:
-            self.U = nn.Parameter(0.1 * torch.randn([hidden_size, uRank]))
-            self.U1 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U2 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U3 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U4 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
+            self.U = _normal_param([hidden_size, uRank], factory_kwargs)
+            self.U_ifco = _normal_param([uRank, 4 * hidden_size],
+                                        factory_kwargs)
 
-        self.bias_f = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_i = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_c = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_o = nn.Parameter(torch.ones([1, hidden_size]))
+        self.bias_f = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_i = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_c = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_o = _const_param([1, hidden_size], 1.0, factory_kwargs)
 
     @property
     def gate_nonlinearity(self):
@@ -612,55 +1471,50 @@ class LSTMLRCell(RNNCell):
     def cellType(self):
         return "LSTMLR"
 
-    def forward(self, input, hiddenStates):
-        (h, c) = hiddenStates
-
+    W1 = _gate_property("W_ifco", 0)
+    W2 = _gate_property("W_ifco", 1)
+    W3 = _gate_property("W_ifco", 2)
+    W4 = _gate_property("W_ifco", 3)
+    U1 = _gate_property("U_ifco", 0)
+    U2 = _gate_property("U_ifco", 1)
+    U3 = _gate_property("U_ifco", 2)
+    U4 = _gate_property("U_ifco", 3)
+
+    def precompute_input(self, input):
+        # The gate biases are folded into the input projection
+        bias = torch.cat([self.bias_i, self.bias_f, self.bias_c,
+                          self.bias_o], dim=1)
         if self._wRank is None:
-            wComp1 = torch.matmul(input, self.W1)
-            wComp2 = torch.matmul(input, self.W2)
-            wComp3 = torch.matmul(input, self.W3)
-            wComp4 = torch.matmul(input, self.W4)
+            return _addmm_nd(bias, input, self.W_ifco)
         else:
-            wComp1 = torch.matmul(
-                torch.matmul(input, self.W), self.W1)
-            wComp2 = torch.matmul(
-                torch.matmul(input, self.W), self.W2)
-            wComp3 = torch.matmul(
-                torch.matmul(input, self.W), self.W3)
-            wComp4 = torch.matmul(
-                torch.matmul(input, self.W), self.W4)
+            return _addmm_nd(bias, _gemm(input, self.W), self.W_ifco)
+
+    def forward(self, input, hiddenStates):
+        return self.forward_from_wx(self.precompute_input(input),
+                                    hiddenStates)
+
+    def forward_from_wx(self, wComp, hiddenStates):
+        (h, c) = hiddenStates
 
         if self._uRank is None:
-            uComp1 = torch.matmul(h, self.U1)
-            uComp2 = torch.matmul(h, self.U2)
-            uComp3 = torch.matmul(h, self.U3)
-            uComp4 = torch.matmul(h, self.U4)
+            pre_comp = _gemm(
+                h, self.U_ifco, add=wComp,
+                out=self._scratch("pre_comp", h, 4 * self._hidden_size))
         else:
-            uComp1 = torch.matmul(
-                torch.matmul(h, self.U), self.U1)
-            uComp2 = torch.matmul(
-                torch.matmul(h, self.U), self.U2)
-            uComp3 = torch.matmul(
-                torch.matmul(h, self.U), self.U3)
-            uComp4 = torch.matmul(
-                torch.matmul(h, self.U), self.U4)
-        pre_comp1 = wComp1 + uComp1
-        pre_comp2 = wComp2 + uComp2
-        pre_comp3 = wComp3 + uComp3
-        pre_comp4 = wComp4 + uComp4
-
-        i = gen_nonlinearity(pre_comp1 + self.bias_i,
-                              self._gate_nonlinearity)
-        f = gen_nonlinearity(pre_comp2 + self.bias_f,
-                              self._gate_nonlinearity)
-        o = gen_nonlinearity(pre_comp4 + self.bias_o,
-                              self._gate_nonlinearity)
-
-        c_ = gen_nonlinearity(pre_comp3 + self.bias_c,
-                               self._update_nonlinearity)
+            pre_comp = self._low_rank_matmul(
+                "U", h, self.U, self.U_ifco, add=wComp,
+                out=self._scratch("pre_comp", h, 4 * self._hidden_size))
+        pre_comp1, pre_comp2, pre_comp3, pre_comp4 = \
+            pre_comp.chunk(4, dim=-1)
+
+        i = self._gate_fn(pre_comp1)
+        f = self._gate_fn(pre_comp2)
+        o = self._gate_fn(pre_comp4)
+
+        c_ = self._update_fn(pre_comp3)
 
         new_c = f * c + i * c_
-        new_h = o * gen_nonlinearity(new_c, self._update_nonlinearity)
+        new_h = o * self._update_fn(new_c)
         return new_h, new_c
 
     def getVars(self):
@@ -687,9 +1541,10 @@ class GRULRCell(RNNCell):
     hidden_size = # hidden units
 
     gate_nonlinearity = nonlinearity for the gate can be chosen from
-    [tanh, sigmoid, relu, quantTanh, quantSigm]
+    [tanh, sigmoid, relu, quantTanh, quantSigm, hardSigm, hardTanh]
     update_nonlinearity = nonlinearity for final rnn update
-    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm]
+    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm,
+    hardSigm, hardTanh]
 
     wRank = rank of W matrix
     (creates 4 matrices if not None else creates 3 matrices)
@@ -708,11 +1563,21 @@ class GRULRCell(RNNCell):
 
     Wi and Ui can further parameterised into low rank version by
     Wi = matmul(W, W_i) and Ui = matmul(U, U_i)
+
+    W1..W3 (and U1..U3) are stored side by side in W_all (U_all) so that
+    all three gates share one parameter and one GEMM. W1..W3 and U1..U3
+    remain available as views into them
     '''
 
+    # Version 2 stores W1..W3 and U1..U3 concatenated in W_all and U_all
+    _version = 2
+    _packed_gates = {"W_all": ["W1", "W2", "W3"],
+                     "U_all": ["U1", "U2", "U3"]}
+
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, name="GRULR"):
+                 wSparsity=1.0, uSparsity=1.0, name="GRULR", device=None,
+                 dtype=None):
         super(GRULRCell, self).__init__(input_size, hidden_size,
                                            gate_nonlinearity, update_nonlinearity,
                                            3, 3, 3, wRank, uRank, wSparsity,
@@ -726,36 +1591,27 @@ class GRULRCell(RNNCell):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": device, "dtype": dtype}
         if wRank is None:
-            self.W1 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
-            self.W2 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
-            self.W3 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
+            self.W_all = _normal_param([input_size, 3 * hidden_size],
+                                       factory_kwargs)
         else:
-            self.W = nn.Parameter(0.1 * torch.randn([input_size, wRank]))
-            self.W1 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
-            self.W2 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
-            self.W3 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
+            self.W = _normal_param([input_size, wRank], factory_kwargs)
+            self.W_all = _normal_param([wRank, 3 * hidden_size],
+                                       factory_kwargs)
 
         if uRank is None:
-            self.U1 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
-            self.U2 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
-            self.U3 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
+            self.U_all = _normal_param([hidden_size, 3 * hidden_size],
+                                       factory_kwargs)
         else:
-            self.U = nn.Parameter(0.1 * torch.randn([hidden_size, uRank]))
-            self.U1 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U2 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U3 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
+            self.U = _normal_param([hidden_size, uRank], factory_kwargs)
+            self.U_all = _normal_param([uRank, 3 * hidden_size],
+                                       factory_kwargs)
 
-        self.bias_r = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_gate = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_update = nn.Parameter(torch.ones([1, hidden_size]))
-        self._device = self.bias_update.device
+        self.bias_r = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_gate = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_update = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self._scripted = update_nonlinearity == "tanh"
 
     @property
     def name(self):
@@ -765,48 +1621,95 @@ class GRULRCell(RNNCell):
     def cellType(self):
         return "GRULR"
 
-    def forward(self, input, state):
+    W1 = _gate_property("W_all", 0)
+    W2 = _gate_property("W_all", 1)
+    W3 = _gate_property("W_all", 2)
+    U1 = _gate_property("U_all", 0)
+    U2 = _gate_property("U_all", 1)
+    U3 = _gate_property("U_all", 2)
+
+    def precompute_input(self, input):
+        # All three gates are projected by one GEMM, with the biases folded
+        # in
+        bias = torch.cat([self.bias_r, self.bias_gate, self.bias_update],
+                         dim=1)
         if self._wRank is None:
-            wComp1 = torch.matmul(input, self.W1)
-            wComp2 = torch.matmul(input, self.W2)
-            wComp3 = torch.matmul(input, self.W3)
-        else:
-            wComp1 = torch.matmul(
-                torch.matmul(input, self.W), self.W1)
-            wComp2 = torch.matmul(
-                torch.matmul(input, self.W), self.W2)
-            wComp3 = torch.matmul(
-                torch.matmul(input, self.W), self.W3)
+            return _addmm_nd(bias, input, self.W_all)
+        return _low_rank_project(input, self.W, self.W_all, bias)
+
+    def forward(self, input, state):
+        return self.forward_from_wx(self.precompute_input(input), state)
+
+    def precompute_constants(self):
+        # Matrices of the r and z gates, a view into U_all
+        return (self._gate_view(self.U_all, 0, 2),)
+
+    def forward_from_wx(self, wComp, state, uCat=None):
+        if uCat is None:
+            uCat, = self.precompute_constants()
+        wComp12, wComp3 = wComp.split(
+            [2 * self._hidden_size, self._hidden_size], dim=-1)
 
+        # Both gates come out of a single GEMM; in the low rank case the
+        # shared projection through U is only computed once
         if self._uRank is None:
-            uComp1 = torch.matmul(state, self.U1)
-            uComp2 = torch.matmul(state, self.U2)
+            pre_comp12 = _gemm(
+                state, uCat, add=wComp12,
+                out=self._scratch("pre_comp12", state, 2 * self._hidden_size))
         else:
-            uComp1 = torch.matmul(
-                torch.matmul(state, self.U), self.U1)
-            uComp2 = torch.matmul(
-                torch.matmul(state, self.U), self.U2)
+            pre_comp12 = self._low_rank_matmul(
+                "U12", state, self.U, uCat, add=wComp12,
+                sources=[self.U, self.U_all],
+                out=self._scratch("pre_comp12", state, 2 * self._hidden_size))
+        pre_comp1, pre_comp2 = pre_comp12.chunk(2, dim=-1)
 
-        pre_comp1 = wComp1 + uComp1
-        pre_comp2 = wComp2 + uComp2
-
-        r = gen_nonlinearity(pre_comp1 + self.bias_r,
-                              self._gate_nonlinearity)
-        z = gen_nonlinearity(pre_comp2 + self.bias_gate,
-                              self._gate_nonlinearity)
+        r = self._gate_fn(pre_comp1)
+        z = self._gate_fn(pre_comp2)
 
         if self._uRank is None:
-            pre_comp3 = wComp3 + torch.matmul(r * state, self.U3)
+            pre_comp3 = _gemm(
+                r * state, self.U3, add=wComp3,
+                out=self._scratch("pre_comp3", state, self._hidden_size))
         else:
-            pre_comp3 = wComp3 + \
-                torch.matmul(torch.matmul(r * state, self.U), self.U3)
+            pre_comp3 = self._low_rank_matmul(
+                "U3", r * state, self.U, self.U3, add=wComp3,
+                out=self._scratch("pre_comp3", state, self._hidden_size))
+
+        if self._scripted:
+            return gru_update(pre_comp3, z, state)
 
-        c = gen_nonlinearity(pre_comp3 + self.bias_update,
-                              self._update_nonlinearity)
+        c = self._update_fn(pre_comp3)
 
-        new_h = z * state + (1.0 - z) * c
+        # z * state + (1 - z) * c as a single pointwise kernel
+        new_h = torch.lerp(c, state, z)
         return new_h
 
+    def fused_unroll(self, input, state):
+        '''
+        Runs the whole recurrence over time major input with the numba
+        kernel on the CPU. Returns None unless use_numba is on, numba is
+        installed and the kernel applies
+        '''
+        if not _numba_applicable(self, input):
+            return None
+        uAll = self.U_all if self._uRank is None else \
+            torch.matmul(self.U, self.U_all)
+        U1, U2, U3 = uAll.chunk(3, dim=1)
+        return torch.from_numpy(_rnn_numba.gru_forward(
+            _to_numpy(self.precompute_input(input)), _to_numpy(U1),
+            _to_numpy(U2), _to_numpy(U3), _to_numpy(state)))
+
+    def scripted_unroll(self, wComps, state, uCat):
+        '''
+        Runs the whole recurrence over time major wComps in TorchScript.
+        Returns None unless the nonlinearities are sigmoid and tanh
+        '''
+        if self._gate_nonlinearity != "sigmoid" or not self._scripted:
+            return None
+        lowRank = self._uRank is not None
+        U = self.U if lowRank else state.new_empty(0)
+        return gru_unroll(wComps, state, U, uCat, self.U3, lowRank)
+
     def getVars(self):
         Vars = []
         if self._num_W_matrices == 3:
@@ -831,9 +1734,10 @@ class UGRNNLRCell(RNNCell):
     hidden_size = # hidden units
 
     gate_nonlinearity = nonlinearity for the gate can be chosen from
-    [tanh, sigmoid, relu, quantTanh, quantSigm]
+    [tanh, sigmoid, relu, quantTanh, quantSigm, hardSigm, hardTanh]
     update_nonlinearity = nonlinearity for final rnn update
-    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm]
+    can be chosen from [tanh, sigmoid, relu, quantTanh, quantSigm,
+    hardSigm, hardTanh]
 
     wRank = rank of W matrix
     (creates 3 matrices if not None else creates 2 matrices)
@@ -851,11 +1755,21 @@ class UGRNNLRCell(RNNCell):
 
     Wi and Ui can further parameterised into low rank version by
     Wi = matmul(W, W_i) and Ui = matmul(U, U_i)
+
+    W1, W2 (and U1, U2) are stored side by side in W_all (U_all) so that
+    both gates share one parameter and one GEMM. W1, W2 and U1, U2 remain
+    available as views into them
     '''
 
+    # Version 2 stores W1, W2 and U1, U2 concatenated in W_all and U_all
+    _version = 2
+    _packed_gates = {"W_all": ["W1", "W2"],
+                     "U_all": ["U1", "U2"]}
+
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, name="UGRNNLR"):
+                 wSparsity=1.0, uSparsity=1.0, name="UGRNNLR", device=None,
+                 dtype=None):
         super(UGRNNLRCell, self).__init__(input_size, hidden_size,
                                           gate_nonlinearity, update_nonlinearity,
                                           2, 2, 2, wRank, uRank, wSparsity, uSparsity)
@@ -868,29 +1782,27 @@ class UGRNNLRCell(RNNCell):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": device, "dtype": dtype}
         if wRank is None:
-            self.W1 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
-            self.W2 = nn.Parameter(
-                0.1 * torch.randn([input_size, hidden_size]))
+            self.W_all = _normal_param([input_size, 2 * hidden_size],
+                                       factory_kwargs)
         else:
-            self.W = nn.Parameter(0.1 * torch.randn([input_size, wRank]))
-            self.W1 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
-            self.W2 = nn.Parameter(0.1 * torch.randn([wRank, hidden_size]))
+            self.W = _normal_param([input_size, wRank], factory_kwargs)
+            self.W_all = _normal_param([wRank, 2 * hidden_size],
+                                       factory_kwargs)
 
         if uRank is None:
-            self.U1 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
-            self.U2 = nn.Parameter(
-                0.1 * torch.randn([hidden_size, hidden_size]))
+            self.U_all = _normal_param([hidden_size, 2 * hidden_size],
+                                       factory_kwargs)
         else:
-            self.U = nn.Parameter(0.1 * torch.randn([hidden_size, uRank]))
-            self.U1 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
-            self.U2 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size]))
+            self.U = _normal_param([hidden_size, uRank], factory_kwargs)
+            self.U_all = _normal_param([uRank, 2 * hidden_size],
+                                       factory_kwargs)
 
-        self.bias_gate = nn.Parameter(torch.ones([1, hidden_size]))
-        self.bias_update = nn.Parameter(torch.ones([1, hidden_size]))
-        self._device = self.bias_update.device
+        self.bias_gate = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_update = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self._scripted = (gate_nonlinearity == "sigmoid" and
+                          update_nonlinearity == "tanh")
 
     @property
     def name(self):
@@ -900,36 +1812,70 @@ class UGRNNLRCell(RNNCell):
     def cellType(self):
         return "UGRNNLR"
 
-    def forward(self, input, state):
+    W1 = _gate_property("W_all", 0)
+    W2 = _gate_property("W_all", 1)
+    U1 = _gate_property("U_all", 0)
+    U2 = _gate_property("U_all", 1)
+
+    def precompute_input(self, input):
+        # Both gates are projected by one GEMM, with the biases folded in
+        bias = torch.cat([self.bias_gate, self.bias_update], dim=1)
         if self._wRank is None:
-            wComp1 = torch.matmul(input, self.W1)
-            wComp2 = torch.matmul(input, self.W2)
-        else:
-            wComp1 = torch.matmul(
-                torch.matmul(input, self.W), self.W1)
-            wComp2 = torch.matmul(
-                torch.matmul(input, self.W), self.W2)
+            return _addmm_nd(bias, input, self.W_all)
+        return _low_rank_project(input, self.W, self.W_all, bias)
 
+    def forward(self, input, state):
+        return self.forward_from_wx(self.precompute_input(input), state)
+
+    def forward_from_wx(self, wComp, state):
+        # Both gates come out of a single GEMM; in the low rank case the
+        # shared projection through U is only computed once
         if self._uRank is None:
-            uComp1 = torch.matmul(state, self.U1)
-            uComp2 = torch.matmul(state, self.U2)
+            pre_comp = _gemm(
+                state, self.U_all, add=wComp,
+                out=self._scratch("pre_comp", state, 2 * self._hidden_size))
         else:
-            uComp1 = torch.matmul(
-                torch.matmul(state, self.U), self.U1)
-            uComp2 = torch.matmul(
-                torch.matmul(state, self.U), self.U2)
+            pre_comp = self._low_rank_matmul(
+                "U12", state, self.U, self.U_all, add=wComp,
+                out=self._scratch("pre_comp", state, 2 * self._hidden_size))
+        pre_comp1, pre_comp2 = pre_comp.chunk(2, dim=-1)
 
-        pre_comp1 = wComp1 + uComp1
-        pre_comp2 = wComp2 + uComp2
+        if self._scripted:
+            return ugrnn_step(pre_comp1, pre_comp2, state)
 
-        z = gen_nonlinearity(pre_comp1 + self.bias_gate,
-                              self._gate_nonlinearity)
-        c = gen_nonlinearity(pre_comp2 + self.bias_update,
-                              self._update_nonlinearity)
+        z = self._gate_fn(pre_comp1)
+        c = self._update_fn(pre_comp2)
 
-        new_h = z * state + (1.0 - z) * c
+        # z * state + (1 - z) * c as a single pointwise kernel
+        new_h = torch.lerp(c, state, z)
         return new_h
 
+    def fused_unroll(self, input, state):
+        '''
+        Runs the whole recurrence over time major input with the numba
+        kernel on the CPU. Returns None unless use_numba is on, numba is
+        installed and the kernel applies
+        '''
+        if not _numba_applicable(self, input):
+            return None
+        uAll = self.U_all if self._uRank is None else \
+            torch.matmul(self.U, self.U_all)
+        U1, U2 = uAll.chunk(2, dim=1)
+        return torch.from_numpy(_rnn_numba.ugrnn_forward(
+            _to_numpy(self.precompute_input(input)), _to_numpy(U1),
+            _to_numpy(U2), _to_numpy(state)))
+
+    def scripted_unroll(self, wComps, state):
+        '''
+        Runs the whole recurrence over time major wComps in TorchScript.
+        Returns None unless the nonlinearities are sigmoid and tanh
+        '''
+        if not self._scripted:
+            return None
+        lowRank = self._uRank is not None
+        U = self.U if lowRank else state.new_empty(0)
+        return ugrnn_unroll(wComps, state, U, self.U_all, lowRank)
+
     def getVars(self):
         Vars = []
         if self._num_W_matrices == 2:
@@ -954,6 +1900,20 @@ class BaseRNN(nn.Module):
     We assume input to be batch_first by default ie.,
     [batchSize, timeSteps, inputDims] else
     [timeSteps, batchSize, inputDims]
+
+    input can also be a PackedSequence (see nn.utils.rnn.pack_sequence),
+    in which case finished sequences drop out of the batch and the outputs
+    are returned as a PackedSequence with the same batch_sizes
+
+    out = optional preallocated tensor (a tuple of two for LSTMLR) that the
+    outputs are written into, avoiding an allocation per call at inference.
+    It can't be used when gradients are being computed
+
+    The cell is normally stepped through forward_from_wx, which bypasses
+    its __call__. While forward hooks (on the cell or global) are
+    registered, the cell is instead called on the raw input at every
+    timestep so that the hooks fire, at the cost of the batched input
+    projection and of the fused and scripted unrolls
     '''
 
     def __init__(self, cell: RNNCell, batch_first=True):
@@ -964,55 +1924,180 @@ class BaseRNN(nn.Module):
     def getVars(self):
         return self._RNNCell.getVars()
 
+    def _cell_has_hooks(self):
+        cell = self._RNNCell
+        return bool(cell._forward_hooks or cell._forward_pre_hooks or
+                    nn.modules.module._global_forward_hooks or
+                    nn.modules.module._global_forward_pre_hooks)
+
+    def _cell_step(self, input):
+        '''
+        Returns the per-step inputs of the unroll along with the function
+        taking one of them and the state to the next state
+        '''
+        cell = self._RNNCell
+        if self._cell_has_hooks():
+            return input, cell
+        # The input projections do not depend on the recurrence, so they are
+        # computed for all the timesteps with one matmul and only the state
+        # side of the cell runs inside the loop
+        wComps = cell.precompute_input(input)
+        # Likewise for the terms that only depend on the parameters
+        consts = cell.precompute_constants()
+        return wComps, \
+            lambda wComp, state: cell.forward_from_wx(wComp, state, *consts)
+
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        self._RNNCell.to_bf16_inference(dtype)
+        return self
+
+    def _forward_packed(self, input, hiddenState, cellState, out):
+        data, batch_sizes, sorted_indices, unsorted_indices = input
+        self.device = data.device
+        isLSTM = self._RNNCell.cellType == "LSTMLR"
+        stateShape = [int(batch_sizes[0]), self._RNNCell.output_size]
+        # Given states follow the original batch order like nn.LSTM's hx,
+        # while the packed data is sorted by decreasing length
+        if hiddenState is None:
+            hiddenState = torch.zeros(
+                stateShape, device=data.device, dtype=data.dtype)
+        elif sorted_indices is not None:
+            hiddenState = hiddenState.index_select(0, sorted_indices)
+        if isLSTM:
+            if cellState is None:
+                cellState = torch.zeros(
+                    stateShape, device=data.device, dtype=data.dtype)
+            elif sorted_indices is not None:
+                cellState = cellState.index_select(0, sorted_indices)
+
+        wComps, step = self._cell_step(data)
+
+        # batch_sizes is non-increasing, so the sequences still running at a
+        # step are always the leading rows of the state
+        hiddenStates = []
+        cellStates = []
+        offset = 0
+        for bs in batch_sizes.tolist():
+            wComp = wComps[offset:offset + bs]
+            if isLSTM:
+                hiddenState, cellState = step(
+                    wComp, (hiddenState[:bs], cellState[:bs]))
+                cellStates.append(cellState)
+            else:
+                hiddenState = step(wComp, hiddenState[:bs])
+            hiddenStates.append(hiddenState)
+            offset += bs
+
+        def pack(states, buf):
+            flat = (torch.cat(states, dim=0) if buf is None
+                    else torch.cat(states, dim=0, out=buf))
+            return PackedSequence(flat, batch_sizes, sorted_indices,
+                                  unsorted_indices)
+
+        if isLSTM:
+            if out is None:
+                out = (None, None)
+            return (pack(hiddenStates, out[0]), pack(cellStates, out[1]))
+        return pack(hiddenStates, out)
+
     def forward(self, input, hiddenState=None,
-                cellState=None):
+                cellState=None, out=None):
+        inferDtype = getattr(self._RNNCell, "_infer_dtype", None)
+        inputDtype = input.data.dtype if isinstance(input, PackedSequence) \
+            else input.dtype
+        if inferDtype is not None and inputDtype != torch.float32:
+            # Cells cast by to_bf16_inference keep their states in float32
+            # and only take the GEMM operands in the reduced precision
+            def cast(x, dtype):
+                if x is None or isinstance(x, PackedSequence):
+                    return None if x is None else x.to(dtype)
+                if isinstance(x, tuple):
+                    return tuple(cast(t, dtype) for t in x)
+                return x.to(dtype)
+            def copyOut(buf, x):
+                if isinstance(x, PackedSequence):
+                    return x._replace(data=buf.copy_(x.data))
+                return buf.copy_(x)
+            output = cast(self.forward(cast(input, torch.float32),
+                                       cast(hiddenState, torch.float32),
+                                       cast(cellState, torch.float32)),
+                          inputDtype)
+            if out is None:
+                return output
+            if isinstance(output, tuple) and \
+                    not isinstance(output, PackedSequence):
+                return tuple(copyOut(o, t) for o, t in zip(out, output))
+            return copyOut(out, output)
+        if isinstance(input, PackedSequence):
+            return self._forward_packed(input, hiddenState, cellState, out)
         self.device = input.device
-        hiddenStates = torch.zeros(
-                [input.shape[0], input.shape[1],
-                 self._RNNCell.output_size]).to(self.device)
+        timeDim = 1 if self._batch_first else 0
+        batchSize = input.shape[1 - timeDim]
         if hiddenState is None:
-                hiddenState = torch.zeros(
-                    [input.shape[0] if self._batch_first else input.shape[1],
-                    self._RNNCell.output_size]).to(self.device)
-
-        if self._batch_first is True:
-            if self._RNNCell.cellType == "LSTMLR":
-                cellStates = torch.zeros(
-                    [input.shape[0], input.shape[1],
-                     self._RNNCell.output_size]).to(self.device)
-                if cellState is None:
-                    cellState = torch.zeros(
-                        [input.shape[0], self._RNNCell.output_size]).to(self.device)
-                for i in range(0, input.shape[1]):
-                    hiddenState, cellState = self._RNNCell(
-                        input[:, i, :], (hiddenState, cellState))
-                    hiddenStates[:, i, :] = hiddenState
-                    cellStates[:, i, :] = cellState
-                return hiddenStates, cellStates
-            else:
-                for i in range(0, input.shape[1]):
-                    hiddenState = self._RNNCell(input[:, i, :], hiddenState)
-                    hiddenStates[:, i, :] = hiddenState
-                return hiddenStates
+            hiddenState = torch.zeros(
+                [batchSize, self._RNNCell.output_size],
+                device=input.device, dtype=input.dtype)
+
+        hooked = self._cell_has_hooks()
+
+        # At inference, cells backed by a fused kernel (use_fused_kernel,
+        # use_numba) can run the whole sequence in it
+        if not torch.is_grad_enabled() and not hooked and \
+                not torch.onnx.is_in_onnx_export() and \
+                hasattr(self._RNNCell, "fused_unroll"):
+            timeMajor = input.transpose(0, 1) if self._batch_first else input
+            output = self._RNNCell.fused_unroll(timeMajor, hiddenState)
+            if output is not None:
+                output = output.transpose(0, 1) if self._batch_first \
+                    else output
+                return output if out is None else out.copy_(output)
+
+        wComps, step = self._cell_step(input)
+
+        # When exporting to ONNX, cells with a scripted unroll are recorded as
+        # one Loop over the sequence instead of timeSteps unrolled copies of
+        # the step, which also keeps the sequence length dynamic. Cells can
+        # also opt into it with script_unroll to drop the per-step Python
+        # dispatch
+        if (torch.onnx.is_in_onnx_export() or
+                getattr(self._RNNCell, "_script_unroll", False)) and \
+                inferDtype is None and not hooked and \
+                hasattr(self._RNNCell, "scripted_unroll"):
+            timeMajor = wComps.transpose(0, 1) if self._batch_first \
+                else wComps
+            output = self._RNNCell.scripted_unroll(
+                timeMajor, hiddenState,
+                *self._RNNCell.precompute_constants())
+            if output is not None:
+                output = output.transpose(0, 1) if self._batch_first \
+                    else output
+                return output if out is None else out.copy_(output)
+
+        # Per-step outputs are collected in a list and stacked once instead
+        # of being written into a preallocated tensor at every timestep
+        hiddenStates = []
+        if self._RNNCell.cellType == "LSTMLR":
+            cellStates = []
+            if cellState is None:
+                cellState = torch.zeros(
+                    [batchSize, self._RNNCell.output_size],
+                    device=input.device, dtype=input.dtype)
+            for wComp in wComps.unbind(timeDim):
+                hiddenState, cellState = step(wComp, (hiddenState, cellState))
+                hiddenStates.append(hiddenState)
+                cellStates.append(cellState)
+            if out is not None:
+                return (torch.stack(hiddenStates, dim=timeDim, out=out[0]),
+                        torch.stack(cellStates, dim=timeDim, out=out[1]))
+            return (torch.stack(hiddenStates, dim=timeDim),
+                    torch.stack(cellStates, dim=timeDim))
         else:
-            if self._RNNCell.cellType == "LSTMLR":
-                cellStates = torch.zeros(
-                    [input.shape[0], input.shape[1],
-                     self._RNNCell.output_size]).to(self.device)
-                if cellState is None:
-                    cellState = torch.zeros(
-                        [input.shape[1], self._RNNCell.output_size]).to(self.device)
-                for i in range(0, input.shape[0]):
-                    hiddenState, cellState = self._RNNCell(
-                        input[i, :, :], (hiddenState, cellState))
-                    hiddenStates[i, :, :] = hiddenState
-                    cellStates[i, :, :] = cellState
-                return hiddenStates, cellStates
-            else:
-                for i in range(0, input.shape[0]):
-                    hiddenState = self._RNNCell(input[i, :, :], hiddenState)
-                    hiddenStates[i, :, :] = hiddenState
-                return hiddenStates
+            for wComp in wComps.unbind(timeDim):
+                hiddenState = step(wComp, hiddenState)
+                hiddenStates.append(hiddenState)
+            if out is not None:
+                return torch.stack(hiddenStates, dim=timeDim, out=out)
+            return torch.stack(hiddenStates, dim=timeDim)
 
 
 class LSTM(nn.Module):
@@ -1020,15 +2105,50 @@ class LSTM(nn.Module):
 
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, batch_first=True):
+                 wSparsity=1.0, uSparsity=1.0, batch_first=True,
+                 device=None, dtype=None):
         super(LSTM, self).__init__()
         self.cell = LSTMLRCell(input_size, hidden_size,
                                gate_nonlinearity=gate_nonlinearity,
                                update_nonlinearity=update_nonlinearity,
                                wRank=wRank, uRank=uRank,
-                               wSparsity=wSparsity, uSparsity=uSparsity)
+                               wSparsity=wSparsity, uSparsity=uSparsity,
+                               device=device, dtype=dtype)
         self.unrollRNN = BaseRNN(self.cell, batch_first=batch_first)
 
+    def to_cudnn(self):
+        '''
+        Returns an nn.LSTM holding the weights of this LSTM, which runs the
+        whole sequence in cuDNN on the GPU. Only the full rank, sigmoid/tanh
+        configuration computes the same function as nn.LSTM. Unlike this
+        module, nn.LSTM returns (output, (h_n, c_n)) rather than the hidden
+        and cell states of every timestep
+        '''
+        cell = self.cell
+        if cell.wRank is not None or cell.uRank is not None or \
+                cell.gate_nonlinearity != "sigmoid" or \
+                cell.update_nonlinearity != "tanh":
+            raise ValueError("Only a full rank LSTM with sigmoid gates " +
+                             "and tanh updates maps onto nn.LSTM")
+        lstm = nn.LSTM(cell.input_size, cell.state_size,
+                       batch_first=self.unrollRNN._batch_first,
+                       device=cell.W_ifco.device, dtype=cell.W_ifco.dtype)
+        # nn.LSTM keeps its gates in the same i, f, c, o order, stored as
+        # [out, in], and adds two biases of which one is enough here
+        with torch.no_grad():
+            lstm.weight_ih_l0.copy_(cell.W_ifco.t())
+            lstm.weight_hh_l0.copy_(cell.U_ifco.t())
+            lstm.bias_ih_l0.copy_(torch.cat(
+                [cell.bias_i, cell.bias_f, cell.bias_c, cell.bias_o],
+                dim=1)[0])
+            lstm.bias_hh_l0.zero_()
+        lstm.flatten_parameters()
+        return lstm
+
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        self.cell.to_bf16_inference(dtype)
+        return self
+
     def forward(self, input, hiddenState=None, cellState=None):
         return self.unrollRNN(input, hiddenState, cellState)
 
@@ -1038,15 +2158,21 @@ class GRU(nn.Module):
 
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, batch_first=True):
+                 wSparsity=1.0, uSparsity=1.0, batch_first=True,
+                 device=None, dtype=None):
         super(GRU, self).__init__()
         self.cell = GRULRCell(input_size, hidden_size,
                               gate_nonlinearity=gate_nonlinearity,
                               update_nonlinearity=update_nonlinearity,
                               wRank=wRank, uRank=uRank,
-                              wSparsity=wSparsity, uSparsity=uSparsity)
+                              wSparsity=wSparsity, uSparsity=uSparsity,
+                              device=device, dtype=dtype)
         self.unrollRNN = BaseRNN(self.cell, batch_first=batch_first)
 
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        self.cell.to_bf16_inference(dtype)
+        return self
+
     def forward(self, input, hiddenState=None, cellState=None):
         return self.unrollRNN(input, hiddenState, cellState)
 
@@ -1056,15 +2182,21 @@ class UGRNN(nn.Module):
 
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, batch_first=True):
+                 wSparsity=1.0, uSparsity=1.0, batch_first=True,
+                 device=None, dtype=None):
         super(UGRNN, self).__init__()
         self.cell = UGRNNLRCell(input_size, hidden_size,
                                 gate_nonlinearity=gate_nonlinearity,
                                 update_nonlinearity=update_nonlinearity,
                                 wRank=wRank, uRank=uRank,
-                                wSparsity=wSparsity, uSparsity=uSparsity)
+                                wSparsity=wSparsity, uSparsity=uSparsity,
+                                device=device, dtype=dtype)
         self.unrollRNN = BaseRNN(self.cell, batch_first=batch_first)
 
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        self.cell.to_bf16_inference(dtype)
+        return self
+
     def forward(self, input, hiddenState=None, cellState=None):
         return self.unrollRNN(input, hiddenState, cellState)
 
@@ -1074,16 +2206,22 @@ class FastRNN(nn.Module):
 
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
-                 wSparsity=1.0, uSparsity=1.0, alphaInit=-3.0, betaInit=3.0, batch_first=True):
+                 wSparsity=1.0, uSparsity=1.0, alphaInit=-3.0, betaInit=3.0, batch_first=True,
+                 device=None, dtype=None):
         super(FastRNN, self).__init__()
         self.cell = FastRNNCell(input_size, hidden_size,
                                 gate_nonlinearity=gate_nonlinearity,
                                 update_nonlinearity=update_nonlinearity,
                                 wRank=wRank, uRank=uRank,
                                 wSparsity=wSparsity, uSparsity=uSparsity,
-                                alphaInit=alphaInit, betaInit=betaInit)
+                                alphaInit=alphaInit, betaInit=betaInit,
+                                device=device, dtype=dtype)
         self.unrollRNN = BaseRNN(self.cell, batch_first=batch_first)
 
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        self.cell.to_bf16_inference(dtype)
+        return self
+
     def forward(self, input, hiddenState=None, cellState=None):
         return self.unrollRNN(input, hiddenState, cellState)
 
@@ -1094,34 +2232,145 @@ class FastGRNN(nn.Module):
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None,
                  wSparsity=1.0, uSparsity=1.0, zetaInit=1.0, nuInit=-4.0,
-                 batch_first=True):
+                 batch_first=True, device=None, dtype=None):
         super(FastGRNN, self).__init__()
         self.cell = FastGRNNCell(input_size, hidden_size,
                                  gate_nonlinearity=gate_nonlinearity,
                                  update_nonlinearity=update_nonlinearity,
                                  wRank=wRank, uRank=uRank,
                                  wSparsity=wSparsity, uSparsity=uSparsity,
-                                 zetaInit=zetaInit, nuInit=nuInit)
+                                 zetaInit=zetaInit, nuInit=nuInit,
+                                 device=device, dtype=dtype)
         self.unrollRNN = BaseRNN(self.cell, batch_first=batch_first)
 
     def getVars(self):
         return self.unrollRNN.getVars()
 
+    def compile_sparse(self, enable=True):
+        self.cell.compile_sparse(enable)
+
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        self.cell.to_bf16_inference(dtype)
+        return self
+
     def forward(self, input, hiddenState=None, cellState=None):
         return self.unrollRNN(input, hiddenState, cellState)
 
+class StackedFastGRNN(nn.Module):
+    """
+    Multi layer and optionally bidirectional FastGRNN, laid out like nn.GRU
+
+    Every layer and direction has its own FastGRNNCell unrolled by BaseRNN,
+    so each gets the single matmul input projection and the fused step.
+    The reverse direction runs on the time flipped sequence. The outputs of
+    both directions are concatenated along the feature dimension
+
+    hiddenState = optional [num_layers * num_directions, batch, hidden_size]
+    initial states, ordered like nn.GRU's h_0
+
+    forward returns (output, h_n) like nn.GRU, with h_n the final states in
+    the same layout as hiddenState. PackedSequence inputs are supported
+    when unidirectional only, as flipping the padded time axis would not
+    reverse the sequences within their own lengths
+    """
+
+    def __init__(self, input_size, hidden_size, num_layers=1,
+                 bidirectional=False, gate_nonlinearity="sigmoid",
+                 update_nonlinearity="tanh", wRank=None, uRank=None,
+                 wSparsity=1.0, uSparsity=1.0, zetaInit=1.0, nuInit=-4.0,
+                 batch_first=True, device=None, dtype=None):
+        super(StackedFastGRNN, self).__init__()
+        self._num_layers = num_layers
+        self._num_directions = 2 if bidirectional else 1
+        self._batch_first = batch_first
+        self.layers = nn.ModuleList()
+        for layer in range(num_layers):
+            layer_input_size = input_size if layer == 0 else \
+                hidden_size * self._num_directions
+            for direction in range(self._num_directions):
+                cell = FastGRNNCell(layer_input_size, hidden_size,
+                                    gate_nonlinearity=gate_nonlinearity,
+                                    update_nonlinearity=update_nonlinearity,
+                                    wRank=wRank, uRank=uRank,
+                                    wSparsity=wSparsity, uSparsity=uSparsity,
+                                    zetaInit=zetaInit, nuInit=nuInit,
+                                    device=device, dtype=dtype)
+                self.layers.append(BaseRNN(cell, batch_first=batch_first))
+
+    @property
+    def cells(self):
+        return [rnn._RNNCell for rnn in self.layers]
+
+    def getVars(self):
+        Vars = []
+        for cell in self.cells:
+            Vars.extend(cell.getVars())
+        return Vars
+
+    def get_model_size(self):
+        return sum(cell.get_model_size() for cell in self.cells)
+
+    def sparsify(self):
+        for cell in self.cells:
+            cell.sparsify()
+
+    def sparsifyWithSupport(self):
+        for cell in self.cells:
+            cell.sparsifyWithSupport()
+
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        for cell in self.cells:
+            cell.to_bf16_inference(dtype)
+        return self
+
+    def _last_state(self, output):
+        if isinstance(output, PackedSequence):
+            padded, lengths = pad_packed_sequence(
+                output, batch_first=self._batch_first)
+            if not self._batch_first:
+                padded = padded.transpose(0, 1)
+            return padded[torch.arange(padded.shape[0]), lengths - 1]
+        return output.select(1 if self._batch_first else 0, -1)
+
+    def forward(self, input, hiddenState=None):
+        if isinstance(input, PackedSequence) and self._num_directions == 2:
+            raise ValueError("StackedFastGRNN does not support "
+                             "PackedSequence inputs when bidirectional")
+        timeDim = 1 if self._batch_first else 0
+        output = input
+        h_n = []
+        for layer in range(self._num_layers):
+            outputs = []
+            for direction in range(self._num_directions):
+                index = layer * self._num_directions + direction
+                h0 = None if hiddenState is None else hiddenState[index]
+                rnn = self.layers[index]
+                if direction == 0:
+                    outputs.append(rnn(output, h0))
+                    h_n.append(self._last_state(outputs[-1]))
+                else:
+                    # The reverse direction ends on the first timestep
+                    outputs.append(
+                        rnn(output.flip(timeDim), h0).flip(timeDim))
+                    h_n.append(outputs[-1].select(timeDim, 0))
+            output = outputs[0] if len(outputs) == 1 else \
+                torch.cat(outputs, dim=-1)
+        return output, torch.stack(h_n)
+
 class FastGRNNCUDA(nn.Module):
     """Unrolled implementation of the FastGRNNCUDACell"""
     def __init__(self, input_size, hidden_size, gate_nonlinearity="sigmoid",
                  update_nonlinearity="tanh", wRank=None, uRank=None, 
                  wSparsity=1.0, uSparsity=1.0, zetaInit=1.0, nuInit=-4.0,
-                 batch_first=False, name="FastGRNNCUDA"):
+                 batch_first=False, name="FastGRNNCUDA", device=None,
+                 dtype=None):
         super(FastGRNNCUDA, self).__init__()
         if utils.findCUDA() is None:
             raise Exception('FastGRNNCUDA is supported only on GPU devices.')
         NON_LINEARITY = {"sigmoid": 0, "relu": 1, "tanh": 2}
         self._input_size = input_size
         self._hidden_size = hidden_size
+        self._model_size_cache = None
         self._zetaInit = zetaInit
         self._nuInit = nuInit
         self._name = name
@@ -1133,8 +2382,7 @@ class FastGRNNCUDA(nn.Module):
         self._uRank = uRank
         self._wSparsity = wSparsity
         self._uSparsity = uSparsity
-        self.oldmats = []
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda" if device is None else device)
         self.batch_first = batch_first
         if wRank is not None:
             self._num_W_matrices += 1
@@ -1144,30 +2392,31 @@ class FastGRNNCUDA(nn.Module):
             self._num_weight_matrices[1] = self._num_U_matrices
         self._name = name
 
+        factory_kwargs = {"device": self.device, "dtype": dtype}
         if wRank is None:
-            self.W = nn.Parameter(0.1 * torch.randn([hidden_size, input_size], device=self.device))
-            self.W1 = torch.empty(0)
-            self.W2 = torch.empty(0)
+            self.W = _normal_param([hidden_size, input_size], factory_kwargs)
+            self.W1 = torch.empty(0, **factory_kwargs)
+            self.W2 = torch.empty(0, **factory_kwargs)
         else:
-            self.W = torch.empty(0)
-            self.W1 = nn.Parameter(0.1 * torch.randn([wRank, input_size], device=self.device))
-            self.W2 = nn.Parameter(0.1 * torch.randn([hidden_size, wRank], device=self.device))
+            self.W = torch.empty(0, **factory_kwargs)
+            self.W1 = _normal_param([wRank, input_size], factory_kwargs)
+            self.W2 = _normal_param([hidden_size, wRank], factory_kwargs)
 
         if uRank is None:
-            self.U = nn.Parameter(0.1 * torch.randn([hidden_size, hidden_size], device=self.device))
-            self.U1 = torch.empty(0)
-            self.U2 = torch.empty(0)
+            self.U = _normal_param([hidden_size, hidden_size], factory_kwargs)
+            self.U1 = torch.empty(0, **factory_kwargs)
+            self.U2 = torch.empty(0, **factory_kwargs)
         else:
-            self.U = torch.empty(0)
-            self.U1 = nn.Parameter(0.1 * torch.randn([uRank, hidden_size], device=self.device))
-            self.U2 = nn.Parameter(0.1 * torch.randn([hidden_size, uRank], device=self.device))
+            self.U = torch.empty(0, **factory_kwargs)
+            self.U1 = _normal_param([uRank, hidden_size], factory_kwargs)
+            self.U2 = _normal_param([hidden_size, uRank], factory_kwargs)
 
         self._gate_non_linearity = NON_LINEARITY[gate_nonlinearity]
 
-        self.bias_gate = nn.Parameter(torch.ones([1, hidden_size], device=self.device))
-        self.bias_update = nn.Parameter(torch.ones([1, hidden_size], device=self.device))
-        self.zeta = nn.Parameter(self._zetaInit * torch.ones([1, 1], device=self.device))
-        self.nu = nn.Parameter(self._nuInit * torch.ones([1, 1], device=self.device))
+        self.bias_gate = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.bias_update = _const_param([1, hidden_size], 1.0, factory_kwargs)
+        self.zeta = _const_param([1, 1], self._zetaInit, factory_kwargs)
+        self.nu = _const_param([1, 1], self._nuInit, factory_kwargs)
 
     def forward(self, input, hiddenState, cell_state=None):
         # input: [timesteps, batch, features, state_size]
@@ -1177,12 +2426,18 @@ class FastGRNNCUDA(nn.Module):
             input = input.to(self.device)
         if hiddenState is None:
             hiddenState = torch.zeros(
-                [input.shape[1], self._hidden_size]).to(self.device)
+                [input.shape[1], self._hidden_size], device=self.device,
+                dtype=input.dtype)
         if not hiddenState.is_cuda:
             hiddenState = hiddenState.to(self.device)
         return FastGRNNUnrollFunction.apply(input, self.bias_gate, self.bias_update, self.zeta, self.nu, hiddenState,
             self.W, self.U, self.W1, self.W2, self.U1, self.U2, self._gate_non_linearity)
 
+    def _apply(self, fn, *args, **kwargs):
+        # See RNNCell._apply
+        self._model_size_cache = None
+        return super(FastGRNNCUDA, self)._apply(fn, *args, **kwargs)
+
     def getVars(self):
         Vars = []
         if self._num_W_matrices == 1:
@@ -1203,32 +2458,39 @@ class FastGRNNCUDA(nn.Module):
 		Function to get aimed model size
 		'''
         mats = self.getVars()
+        # Reuse the last count while none of the weights have been replaced
+        # or modified in place since
+        key = _weights_key(mats)
+        if self._model_size_cache is not None and \
+                self._model_size_cache[0] == key:
+            return self._model_size_cache[1]
         endW = self._num_W_matrices
         endU = endW + self._num_U_matrices
 
         totalnnz = 2  # For Zeta and Nu
         for i in range(0, endW):
-            device = mats[i].device
-            totalnnz += utils.countNNZ(mats[i].cpu(), self._wSparsity)
-            mats[i].to(device)
+            totalnnz += utils.countNNZ(mats[i], self._wSparsity)
         for i in range(endW, endU):
-            device = mats[i].device
-            totalnnz += utils.countNNZ(mats[i].cpu(), self._uSparsity)
-            mats[i].to(device)
+            totalnnz += utils.countNNZ(mats[i], self._uSparsity)
         for i in range(endU, len(mats)):
-            device = mats[i].device
-            totalnnz += utils.countNNZ(mats[i].cpu(), False)
-            mats[i].to(device)
+            totalnnz += utils.countNNZ(mats[i], False)
+        self._model_size_cache = (key, totalnnz * 4)
         return totalnnz * 4
 
+    @property
+    def oldmats(self):
+        num_mats = self._num_W_matrices + self._num_U_matrices
+        return [self._buffers["oldmat_" + str(i)] for i in range(num_mats)
+                if "oldmat_" + str(i) in self._buffers]
+
     def copy_previous_UW(self):
         mats = self.getVars()
         num_mats = self._num_W_matrices + self._num_U_matrices
-        if len(self.oldmats) != num_mats:
-            for i in range(num_mats):
-                self.oldmats.append(torch.FloatTensor())
+        # Snapshots stay on the device of the weights and, as non persistent
+        # buffers, follow the module across .to() without being checkpointed
         for i in range(num_mats):
-            self.oldmats[i] = torch.FloatTensor(mats[i].detach().clone().to(mats[i].device))
+            self.register_buffer("oldmat_" + str(i),
+                                 mats[i].detach().clone(), persistent=False)
 
     def sparsify(self):
         mats = self.getVars()
@@ -1238,6 +2500,7 @@ class FastGRNNCUDA(nn.Module):
             mats[i] = utils.hardThreshold(mats[i], self._wSparsity)
         for i in range(endW, endU):
             mats[i] = utils.hardThreshold(mats[i], self._uSparsity)
+        self._model_size_cache = None
         self.copy_previous_UW()
 
     def sparsifyWithSupport(self):
@@ -1245,6 +2508,7 @@ class FastGRNNCUDA(nn.Module):
         endU = self._num_W_matrices + self._num_U_matrices
         for i in range(0, endU):
             mats[i] = utils.supportBasedThreshold(mats[i], self.oldmats[i])
+        self._model_size_cache = None
 
 class SRNN2(nn.Module):
 
@@ -1294,10 +2558,38 @@ class SRNN2(nn.Module):
 
         self.rnn0 = self.rnnClass(input_size=inputDim, hidden_size=hiddenDim0, **self.cellArgs)
         self.rnn1 = self.rnnClass(input_size=hiddenDim0, hidden_size=hiddenDim1, **self.cellArgs)
-        self.W = torch.randn([self.hiddenDim1, self.outputDim])
-        self.W = nn.Parameter(self.W)
-        self.B = torch.randn([self.outputDim])
-        self.B = nn.Parameter(self.B)
+        # device and dtype in cellArgs are factory kwargs of every rnnClass
+        # and are used for the output layer too
+        factory_kwargs = {"device": cellArgs.get("device"),
+                          "dtype": cellArgs.get("dtype")}
+        self.W = nn.Parameter(torch.randn([self.hiddenDim1, self.outputDim],
+                                          **factory_kwargs))
+        self.B = nn.Parameter(torch.randn([self.outputDim], **factory_kwargs))
+        # Zero initial states, expanded to the batch in forward instead of
+        # each layer allocating and zero filling new ones on every call
+        self.register_buffer("_h0_l0",
+                             torch.zeros([1, 1, hiddenDim0], **factory_kwargs),
+                             persistent=False)
+        self.register_buffer("_h0_l1",
+                             torch.zeros([1, 1, hiddenDim1], **factory_kwargs),
+                             persistent=False)
+        # Created once so that they are registered submodules and follow
+        # train()/eval()
+        self.dropoutLayer0 = None
+        self.dropoutLayer1 = None
+        if dropoutProbability0 != None:
+            self.dropoutLayer0 = nn.Dropout(p=dropoutProbability0)
+        if dropoutProbability1 != None:
+            self.dropoutLayer1 = nn.Dropout(p=dropoutProbability1)
+
+    def _runLayer(self, rnn, x, h0):
+        batchSize = x.shape[1]
+        if self.cellType == 'LSTM':
+            # cuDNN needs contiguous initial states
+            h0 = h0.expand(1, batchSize, h0.shape[2]).contiguous()
+            hidd, _ = rnn(x, (h0, h0))
+            return hidd
+        return rnn(x, h0[0].expand(batchSize, h0.shape[2]))
 
     def getBrickedData(self, x, brickSize):
         '''
@@ -1306,16 +2598,13 @@ class SRNN2(nn.Module):
         along 0-th axes.
         '''
         timeSteps = list(x.size())[0]
-        numSplits = int(timeSteps / brickSize)
         batchSize = list(x.size())[1]
         featureDim = list(x.size())[2]
         numBricks = int(timeSteps/brickSize)
-        eqlen = numSplits * brickSize
-        x = x[:eqlen]
-        x_bricked = torch.split(x, numSplits, dim = 0)
-        x_bricked_batched = torch.cat(x_bricked)
-        x_bricked_batched = torch.reshape(x_bricked_batched, (numBricks,brickSize,batchSize,featureDim))
-        return x_bricked_batched
+        eqlen = numBricks * brickSize
+        # Consecutive runs of brickSize steps form the bricks, so for a
+        # contiguous x this is a view and no data is copied
+        return x[:eqlen].reshape(numBricks, brickSize, batchSize, featureDim)
 
     def forward(self, x, brickSize):
         '''
@@ -1339,30 +2628,20 @@ class SRNN2(nn.Module):
         # x bricks: [brickSize, numBricks * batchSize, featureDim]
         # x_bricks = torch.Tensor(x_bricks)
 
-        self.dropoutLayer0 = None
-        self.dropoutLayer1 = None
-
-        if self.cellType == 'LSTM':
-            hidd0, out0 = self.rnn0(x_bricks)
-        else:
-            hidd0 = self.rnn0(x_bricks)
-
-        if self.dropoutProbability0 != None:
-            self.dropoutLayer0 = nn.Dropout(p=self.dropoutProbability0)
+        hidd0 = self._runLayer(self.rnn0, x_bricks, self._h0_l0)
+        if self.dropoutLayer0 is not None:
             hidd0 = self.dropoutLayer0(hidd0)
-        hidd0 = torch.squeeze(hidd0[-1])
+        # Indexed rather than squeezed so that a batch of one is kept
+        hidd0 = hidd0[-1]
         # [numBricks * batchSize, hiddenDim0]
         inp1 = hidd0.view(oldShape[1], oldShape[2], self.hiddenDim0)
         # [numBricks, batchSize, hiddenDim0]
-        if self.cellType == 'LSTM':
-            hidd1, out1 = self.rnn1(inp1)
-        else:
-            hidd1 = self.rnn1(inp1)
-        if self.dropoutProbability1 != None:
-            self.dropoutLayer1 = nn.Dropout(p=self.dropoutProbability1)
+        hidd1 = self._runLayer(self.rnn1, inp1, self._h0_l1)
+        if self.dropoutLayer1 is not None:
             hidd1 = self.dropoutLayer1(hidd1)
-        hidd1 = torch.squeeze(hidd1[-1])
-        out = torch.matmul(hidd1, self.W) + self.B
+        hidd1 = hidd1[-1]
+        # [batchSize, hiddenDim1]
+        out = torch.addmm(self.B, hidd1, self.W)
         return out
 
 class FastGRNNFunction(Function):
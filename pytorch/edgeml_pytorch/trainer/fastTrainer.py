@@ -59,7 +59,11 @@ class FastTrainer:
         self.FCbias = nn.Parameter(torch.randn(
             [self.numClasses])).to(self.device)
 
-        self.FastParams = self.FastObj.getVars()
+    @property
+    def FastParams(self):
+        # Fetched on every use: getVars can return views of the parameters,
+        # which would go stale once FastObj is moved with .to()
+        return self.FastObj.getVars()
 
     def classifier(self, feats):
         '''
@@ -124,9 +128,14 @@ class FastTrainer:
         for i in range(self.numMatrices[0], self.totalMatrices):
             thrsdParams.append(
                 utils.hardThreshold(self.FastParams[i].data.cpu(), self.sU))
-        for i in range(0, self.totalMatrices):
-            self.FastParams[i].data = torch.FloatTensor(
-                thrsdParams[i]).to(self.device)
+        # Copy in place so that matrices which are views into a larger
+        # parameter (e.g. LSTMLRCell's W1..W4) are written through. Writing
+        # through the tensor rather than .data bumps its version counter,
+        # which the caches of the cells are keyed on
+        fastParams = self.FastParams
+        with torch.no_grad():
+            for i in range(0, self.totalMatrices):
+                fastParams[i].copy_(thrsdParams[i])
         for i in range(0, self.totalMatrices):
             self.thrsdParams.append(torch.FloatTensor(
                 np.copy(thrsdParams[i])).to(self.device))
@@ -136,12 +145,14 @@ class FastTrainer:
         Function to run the Sparse Retraining routine on FastObj
         '''
         self.reTrainParams = []
+        fastParams = self.FastParams
         for i in range(0, self.totalMatrices):
             self.reTrainParams.append(
                 utils.copySupport(self.thrsdParams[i],
-                                  self.FastParams[i].data))
-        for i in range(0, self.totalMatrices):
-            self.FastParams[i].data = self.reTrainParams[i]
+                                  fastParams[i].data))
+        with torch.no_grad():
+            for i in range(0, self.totalMatrices):
+                fastParams[i].copy_(self.reTrainParams[i])
 
     def getModelSize(self):
         '''
@@ -124,14 +124,11 @@ def countNNZ(A: torch.nn.Parameter, isSparse):
     '''
     Returns # of non-zeros 
     '''
-    A_ = A.detach().numpy()
+    # Counted on the tensor's own device, without a copy to host memory
     if isSparse:
-        return np.count_nonzero(A_)
+        return int(torch.count_nonzero(A.detach()).item())
     else:
-        nnzs = 1
-        for i in range(0, len(A.shape)):
-            nnzs *= int(A.shape[i])
-        return nnzs
+        return A.numel()
 
 def restructreMatrixBonsaiSeeDot(A, nClasses, nNodes):
     '''
@@ -0,0 +1,376 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from edgeml_pytorch.graph.rnn import BaseRNN, FastGRNNCell, \
+    FastGRNNCellInt8, FastRNNCell, GRULRCell, LSTMLRCell, \
+    StackedFastGRNN, UGRNNLRCell
+from edgeml_pytorch.trainer.fastTrainer import FastTrainer
+
+
+@pytest.mark.parametrize("cellClass", [LSTMLRCell, GRULRCell, UGRNNLRCell])
+def test_sparsify_with_support_on_packed_cell(cellClass):
+    cell = cellClass(8, 16, wSparsity=0.5, uSparsity=0.5)
+    cell.sparsify()
+    support = [(mat != 0).clone() for mat in cell.getVars()[:len(cell.oldmats)]]
+    # Dense updates, as from an optimizer step during retraining
+    with torch.no_grad():
+        for param in cell.parameters():
+            param.add_(1.0)
+    cell.sparsifyWithSupport()
+    for mat, mask in zip(cell.getVars(), support):
+        assert torch.all(mat[~mask] == 0)
+        assert torch.all(mat[mask] != 0)
+
+
+def test_fastgrnn_plain_state_dict_keeps_layout():
+    cell = FastGRNNCell(8, 16, uRank=4)
+    state = {k: v.clone() for k, v in cell.state_dict().items()}
+    other = FastGRNNCell(8, 16, uRank=4)
+    other.load_state_dict(state)
+    for name in ["W", "U1", "U2"]:
+        assert torch.equal(getattr(other, name), getattr(cell, name))
+
+
+def test_fastgrnn_plain_state_dict_square_is_ambiguous():
+    cell = FastGRNNCell(16, 16)
+    state = {k: v.clone() for k, v in cell.state_dict().items()}
+    with pytest.raises(ValueError):
+        FastGRNNCell(16, 16).load_state_dict(state)
+
+
+def test_fastgrnn_saved_params_are_out_by_in(tmp_path):
+    cell = FastGRNNCell(8, 16, uRank=4)
+    FastTrainer(cell, 2).saveParams(str(tmp_path))
+    # The orientation saveParams always wrote and quantizeFastModels reads
+    expected = {"W": (16, 8), "U1": (4, 16), "U2": (16, 4)}
+    for name, shape in expected.items():
+        saved = np.load(os.path.join(str(tmp_path), name + ".npy"))
+        assert saved.shape == shape
+        assert np.array_equal(saved, getattr(cell, name).detach().t().numpy())
+
+
+def test_trainer_sparsify_invalidates_cell_caches():
+    torch.manual_seed(0)
+    cell = FastGRNNCell(8, 16, wSparsity=0.5, uSparsity=0.5)
+    cell.compile_sparse()
+    rnn = BaseRNN(cell).eval()
+    trainer = FastTrainer(cell, 2, sW=0.5, sU=0.5)
+    x = torch.randn(3, 5, 8)
+    with torch.no_grad():
+        rnn(x)
+    cell.get_model_size()
+
+    trainer.runHardThrsd()
+    fresh = FastGRNNCell(8, 16, wSparsity=0.5, uSparsity=0.5)
+    fresh.load_state_dict(cell.state_dict())
+    with torch.no_grad():
+        expected = BaseRNN(fresh).eval()(x)
+        assert torch.allclose(rnn(x), expected, atol=1e-6)
+    assert cell.get_model_size() == fresh.get_model_size()
+
+    # A dtype round trip replaces every parameter
+    cell.to(torch.float64).to(torch.float32)
+    with torch.no_grad():
+        assert torch.allclose(rnn(x), expected, atol=1e-6)
+    assert cell.get_model_size() == fresh.get_model_size()
+
+
+@pytest.mark.parametrize("cellClass", [FastGRNNCell, GRULRCell, UGRNNLRCell])
+def test_bf16_inference_tracks_float32_over_long_sequences(cellClass):
+    torch.manual_seed(0)
+    cell = cellClass(8, 16)
+    rnn = BaseRNN(cell).eval()
+    x = torch.randn(4, 1000, 8)
+    with torch.no_grad():
+        expected = rnn(x)
+        cell.to_bf16_inference()
+        output = rnn(x)
+    assert cell.bias_update.dtype == torch.float32
+    assert output.dtype == torch.float32
+    assert torch.allclose(output, expected, atol=5e-2)
+
+
+# Plain per-step references written from the cell equations, reading the
+# weights through getVars
+
+def _chain(input, mats):
+    for mat in mats:
+        input = torch.matmul(input, mat)
+    return input
+
+def _split(cell):
+    # W and U matrices of getVars; for the gated cells with a low rank
+    # factorisation the shared factor comes first
+    nW, nU = cell.num_W_matrices, cell.num_U_matrices
+    mats = cell.getVars()
+    return mats[:nW], mats[nW:nW + nU]
+
+def _low_rank(input, mats, gates):
+    if len(mats) > gates:
+        return torch.matmul(input, mats[0]), mats[1:]
+    return input, mats
+
+def _fastgrnn_step(cell, x, h):
+    Ws, Us = _split(cell)
+    # getVars hands out [out, in] matrices
+    pre = _chain(x, [W.t() for W in Ws]) + _chain(h, [U.t() for U in Us])
+    z = torch.sigmoid(pre + cell.bias_gate)
+    c = torch.tanh(pre + cell.bias_update)
+    return z * h + (torch.sigmoid(cell.zeta) * (1.0 - z) +
+                    torch.sigmoid(cell.nu)) * c
+
+def _fastrnn_step(cell, x, h):
+    Ws, Us = _split(cell)
+    c = torch.tanh(_chain(x, Ws) + _chain(h, Us) + cell.bias_update)
+    return torch.sigmoid(cell.beta) * h + torch.sigmoid(cell.alpha) * c
+
+def _gru_step(cell, x, h):
+    Ws, Us = _split(cell)
+    xw, Ws = _low_rank(x, Ws, 3)
+    hu, Ugates = _low_rank(h, Us, 3)
+    r = torch.sigmoid(xw @ Ws[0] + hu @ Ugates[0] + cell.bias_r)
+    z = torch.sigmoid(xw @ Ws[1] + hu @ Ugates[1] + cell.bias_gate)
+    rhu, _ = _low_rank(r * h, Us, 3)
+    c = torch.tanh(xw @ Ws[2] + rhu @ Ugates[2] + cell.bias_update)
+    return z * h + (1.0 - z) * c
+
+def _ugrnn_step(cell, x, h):
+    Ws, Us = _split(cell)
+    xw, Ws = _low_rank(x, Ws, 2)
+    hu, Us = _low_rank(h, Us, 2)
+    z = torch.sigmoid(xw @ Ws[0] + hu @ Us[0] + cell.bias_gate)
+    c = torch.tanh(xw @ Ws[1] + hu @ Us[1] + cell.bias_update)
+    return z * h + (1.0 - z) * c
+
+def _lstm_step(cell, x, state):
+    h, c = state
+    Ws, Us = _split(cell)
+    xw, Ws = _low_rank(x, Ws, 4)
+    hu, Us = _low_rank(h, Us, 4)
+    i, f, c_, o = [xw @ W + hu @ U for W, U in zip(Ws, Us)]
+    i = torch.sigmoid(i + cell.bias_i)
+    f = torch.sigmoid(f + cell.bias_f)
+    o = torch.sigmoid(o + cell.bias_o)
+    c = f * c + i * torch.tanh(c_ + cell.bias_c)
+    return o * torch.tanh(c), c
+
+_REFERENCE_STEPS = {FastGRNNCell: _fastgrnn_step, FastRNNCell: _fastrnn_step,
+                    GRULRCell: _gru_step, UGRNNLRCell: _ugrnn_step,
+                    LSTMLRCell: _lstm_step}
+
+def _reference(cell, x):
+    '''
+    Hidden states of cell over the batch first x, one Python step at a time
+    '''
+    h = x.new_zeros([x.shape[0], cell.state_size])
+    state = (h, h) if isinstance(cell, LSTMLRCell) else h
+    outputs = []
+    for xt in x.unbind(1):
+        state = _REFERENCE_STEPS[type(cell)](cell, xt, state)
+        outputs.append(state[0] if isinstance(state, tuple) else state)
+    return torch.stack(outputs, dim=1)
+
+def _hidden(output):
+    return output[0] if isinstance(output, tuple) else output
+
+def _assert_matches_reference(cell, run, x, atol=1e-5):
+    '''
+    Compares run(x) and its gradients to _reference(cell, x)
+    '''
+    x = x.clone().requires_grad_()
+    output = run(x)
+    expected = _reference(cell, x)
+    assert torch.allclose(output, expected, atol=atol)
+    weight = torch.randn_like(expected)
+    inputs = [x] + list(cell.parameters())
+    grads = torch.autograd.grad((output * weight).sum(), inputs)
+    expectedGrads = torch.autograd.grad((expected * weight).sum(), inputs)
+    for grad, expectedGrad in zip(grads, expectedGrads):
+        assert torch.allclose(grad, expectedGrad, atol=atol)
+
+
+_CELLS = [FastGRNNCell, FastRNNCell, GRULRCell, UGRNNLRCell, LSTMLRCell]
+_RANKS = [(None, None), (4, 4)]
+
+
+@pytest.mark.parametrize("cellClass", _CELLS)
+@pytest.mark.parametrize("wRank, uRank", _RANKS)
+def test_gradients_match_reference(cellClass, wRank, uRank):
+    torch.manual_seed(0)
+    cell = cellClass(8, 16, wRank=wRank, uRank=uRank)
+    rnn = BaseRNN(cell)
+    _assert_matches_reference(cell, lambda x: _hidden(rnn(x)),
+                              torch.randn(3, 7, 8))
+
+
+@pytest.mark.parametrize("cellClass", [FastGRNNCell, GRULRCell,
+                                       UGRNNLRCell])
+@pytest.mark.parametrize("wRank, uRank", _RANKS)
+def test_scripted_unroll_matches_reference(cellClass, wRank, uRank):
+    torch.manual_seed(0)
+    cell = cellClass(8, 16, wRank=wRank, uRank=uRank)
+    cell.script_unroll()
+    rnn = BaseRNN(cell)
+    _assert_matches_reference(cell, rnn, torch.randn(3, 7, 8))
+
+
+@pytest.mark.parametrize("cellClass", [FastGRNNCell, GRULRCell,
+                                       UGRNNLRCell])
+def test_packed_sequence_matches_reference(cellClass):
+    torch.manual_seed(0)
+    cell = cellClass(8, 16)
+    rnn = BaseRNN(cell)
+    lengths = [3, 7, 5]
+    x = torch.randn(3, 7, 8, requires_grad=True)
+    packed = pack_padded_sequence(x, lengths, batch_first=True,
+                                  enforce_sorted=False)
+    output, _ = pad_packed_sequence(rnn(packed), batch_first=True)
+    weight = torch.randn_like(output)
+    loss = 0.0
+    expectedLoss = 0.0
+    for i, length in enumerate(lengths):
+        expected = _reference(cell, x[i:i + 1, :length])
+        assert torch.allclose(output[i:i + 1, :length], expected, atol=1e-5)
+        assert torch.all(output[i, length:] == 0)
+        loss = loss + (output[i, :length] * weight[i, :length]).sum()
+        expectedLoss = expectedLoss + \
+            (expected[0] * weight[i, :length]).sum()
+    inputs = [x] + list(cell.parameters())
+    grads = torch.autograd.grad(loss, inputs)
+    expectedGrads = torch.autograd.grad(expectedLoss, inputs)
+    for grad, expectedGrad in zip(grads, expectedGrads):
+        assert torch.allclose(grad, expectedGrad, atol=1e-5)
+
+
+@pytest.mark.parametrize("cellClass", [LSTMLRCell, GRULRCell, UGRNNLRCell])
+@pytest.mark.parametrize("wRank, uRank", _RANKS)
+def test_legacy_gate_matrices_are_stacked(cellClass, wRank, uRank):
+    torch.manual_seed(0)
+    source = cellClass(8, 16, wRank=wRank, uRank=uRank)
+    # The separate per gate matrices of checkpoints from before the packing
+    legacy = {key: value for key, value in source.state_dict().items()
+              if key not in cellClass._packed_gates}
+    for names in cellClass._packed_gates.values():
+        for name in names:
+            legacy[name] = getattr(source, name).detach().clone()
+    cell = cellClass(8, 16, wRank=wRank, uRank=uRank)
+    cell.load_state_dict(legacy)
+    for names in cellClass._packed_gates.values():
+        for name in names:
+            assert torch.equal(getattr(cell, name), legacy[name])
+    rnn = BaseRNN(cell)
+    x = torch.randn(3, 7, 8)
+    with torch.no_grad():
+        assert torch.allclose(_hidden(rnn(x)), _hidden(BaseRNN(source)(x)))
+    _assert_matches_reference(cell, lambda x: _hidden(rnn(x)), x)
+
+
+@pytest.mark.parametrize("cellClass", [GRULRCell, UGRNNLRCell])
+@pytest.mark.parametrize("wRank, uRank", _RANKS)
+def test_numba_kernels_match_reference(cellClass, wRank, uRank):
+    pytest.importorskip("numba")
+    torch.manual_seed(0)
+    cell = cellClass(8, 16, wRank=wRank, uRank=uRank)
+    cell.use_numba()
+    x = torch.randn(3, 7, 8)
+    # The kernels only run without gradients
+    with torch.no_grad():
+        assert torch.allclose(BaseRNN(cell)(x), _reference(cell, x),
+                              atol=1e-5)
+
+
+@pytest.mark.parametrize("wRank, uRank", _RANKS)
+def test_int8_cell_matches_reference(wRank, uRank):
+    torch.manual_seed(0)
+    cell = FastGRNNCell(8, 16, wRank=wRank, uRank=uRank)
+    x = torch.randn(3, 7, 8)
+    qcell = FastGRNNCellInt8.from_float(cell, calibration_input=x)
+    with torch.no_grad():
+        output = BaseRNN(qcell)(x)
+        expected = _reference(cell, x)
+    # Within int8 weight and lookup table rounding
+    assert torch.allclose(output, expected, atol=5e-2)
+
+
+@pytest.mark.parametrize("cellClass", [FastGRNNCell, GRULRCell])
+def test_onnx_loop_matches_reference(cellClass, tmp_path):
+    onnxruntime = pytest.importorskip("onnxruntime")
+    torch.manual_seed(0)
+    cell = cellClass(8, 16)
+    rnn = BaseRNN(cell).eval()
+    path = os.path.join(str(tmp_path), "rnn.onnx")
+    torch.onnx.export(rnn, (torch.randn(3, 5, 8),), path,
+                      input_names=["input"], output_names=["output"],
+                      dynamic_axes={"input": {0: "batch", 1: "time"},
+                                    "output": {0: "batch", 1: "time"}})
+    # A different length than the exported one, which an unrolled graph
+    # could not run
+    x = torch.randn(2, 9, 8)
+    session = onnxruntime.InferenceSession(path)
+    output, = session.run(None, {"input": x.numpy()})
+    with torch.no_grad():
+        expected = _reference(cell, x)
+    assert np.allclose(output, expected.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize("bidirectional", [False, True])
+def test_stacked_fastgrnn_returns_final_states(bidirectional):
+    torch.manual_seed(0)
+    rnn = StackedFastGRNN(8, 16, num_layers=2, bidirectional=bidirectional)
+    x = torch.randn(3, 7, 8)
+    output, h_n = rnn(x)
+    directions = 2 if bidirectional else 1
+    assert output.shape == (3, 7, 16 * directions)
+    assert h_n.shape == (2 * directions, 3, 16)
+    # The last layer's states, forward at the end and reverse at the start
+    assert torch.equal(h_n[-directions], output[:, -1, :16])
+    if bidirectional:
+        assert torch.equal(h_n[-1], output[:, 0, 16:])
+    if not bidirectional:
+        # Chaining through h_n continues the sequence
+        rest, _ = rnn(x[:, 3:], rnn(x[:, :3])[1])
+        assert torch.allclose(rest, output[:, 3:], atol=1e-6)
+
+
+def test_stacked_fastgrnn_packed_input():
+    torch.manual_seed(0)
+    rnn = StackedFastGRNN(8, 16, num_layers=2)
+    lengths = [3, 7, 5]
+    x = torch.randn(3, 7, 8)
+    packed = pack_padded_sequence(x, lengths, batch_first=True,
+                                  enforce_sorted=False)
+    output, h_n = rnn(packed)
+    padded, _ = pad_packed_sequence(output, batch_first=True)
+    for i, length in enumerate(lengths):
+        expected, expectedH = rnn(x[i:i + 1, :length])
+        assert torch.allclose(padded[i:i + 1, :length], expected, atol=1e-6)
+        assert torch.allclose(h_n[:, i:i + 1], expectedH, atol=1e-6)
+
+    bidirectional = StackedFastGRNN(8, 16, bidirectional=True)
+    with pytest.raises(ValueError):
+        bidirectional(packed)
+
+
+@pytest.mark.parametrize("cellClass", [FastGRNNCell, LSTMLRCell])
+def test_cell_forward_hooks_fire_every_step(cellClass):
+    torch.manual_seed(0)
+    cell = cellClass(8, 16)
+    rnn = BaseRNN(cell)
+    x = torch.randn(3, 7, 8)
+    expected = _hidden(rnn(x))
+    inputs = []
+    handle = cell.register_forward_hook(
+        lambda module, args, output: inputs.append(args[0]))
+    output = _hidden(rnn(x))
+    handle.remove()
+    assert len(inputs) == 7
+    assert torch.equal(inputs[0], x[:, 0])
+    assert torch.allclose(output, expected, atol=1e-6)